@@ -2,13 +2,60 @@ import sys
 import os
 import sqlite3
 import logging
+import argparse
+import threading
+import time
+from contextlib import contextmanager
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+# statements refused on the main database of read-only connections
+WRITE_ACTIONS = [
+    sqlite3.SQLITE_INSERT,
+    sqlite3.SQLITE_UPDATE,
+    sqlite3.SQLITE_DELETE,
+    sqlite3.SQLITE_CREATE_TABLE,
+    sqlite3.SQLITE_CREATE_INDEX,
+    sqlite3.SQLITE_DROP_TABLE,
+    sqlite3.SQLITE_DROP_INDEX,
+    sqlite3.SQLITE_ALTER_TABLE,
+]
+
+# normalized layout: columns whose strings are interned in a dictionary table
+DICTIONARIES = [
+    ('file_name','files'),
+    ('dataset','datasets'),
+    ('module','modules'),
+    ('log_key','logKeys'),
+    ('severity','severities'),
+]
+# views with the columns of the flat tables over fact tables of dictionary ids
+FACTS = [
+    ('logMonitor','logCounts',['file_name','module','log_key','severity'],['count']),
+    ('processedFiles','fileDatasets',['file_name','dataset'],[]),
+]
+LAYOUTS = ['flat','normalized']
+
+def readOnlyAuthorizer(action,arg1,arg2,dbname,source):
+    '''Refuse writes to the main database, temporary tables stay writable'''
+    if dbname=='main' and action in WRITE_ACTIONS: return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
 class LogMonitorAPI(object):
 
-    def __init__(self,sqlfile):
+    def __init__(self,sqlfile,explain=False,readonly=False,layout=None,catalog=False):
+        '''
+        readonly opens one read-only connection per thread, so a single instance can be shared by the threads of a server.
+        A read-only database must exist and is never modified, not even to add missing tables.
+        Databases are in WAL mode, readers never block on the writer.
+        layout is flat (one table of strings) or normalized (strings interned in dictionary tables),
+        existing databases keep their layout, new ones are normalized by default.
+        catalog databases of a ShardedLogMonitorAPI only have the shards, the work journal and the metadata.
+        '''
         self.sqlfile = sqlfile
+        self.explain = explain
+        self.readonly = False
+        self.local = threading.local()
 
         logName = 'logMonitor'
         logColumns = {
@@ -19,71 +66,369 @@ class LogMonitorAPI(object):
             'count' : 'INTEGER',
         }
         logUnique = ['file_name','module','log_key','severity']
+        logIndices = ['module','log_key','severity']
         fileName = 'processedFiles'
         fileColumns = {
             'file_name' : 'TEXT',
             'dataset' : 'TEXT',
         }
         fileUnique = ['file_name','dataset']
-        if not os.path.isfile(self.sqlfile):
+        fileIndices = ['dataset']
+        markName = 'datasetMarks'
+        markColumns = {
+            'dataset' : 'TEXT',
+            'nfiles' : 'INTEGER',
+            'last_modified' : 'INTEGER',
+        }
+        markUnique = ['dataset']
+        # rollups of the processed files per dataset
+        summaryName = 'datasetSummary'
+        summaryColumns = {
+            'dataset' : 'TEXT',
+            'module' : 'TEXT',
+            'log_key' : 'TEXT',
+            'severity' : 'TEXT',
+            'count' : 'INTEGER',
+        }
+        summaryUnique = ['dataset','severity','log_key','module']
+        totalName = 'datasetTotals'
+        totalColumns = {
+            'dataset' : 'TEXT',
+            'nfiles' : 'INTEGER',
+        }
+        totalUnique = ['dataset']
+        # database generation, bumped whenever processed data changes
+        metaName = 'metadata'
+        metaColumns = {
+            'key' : 'TEXT',
+            'value' : 'INTEGER',
+        }
+        metaUnique = ['key']
+        # state of each file handed to the workers, so crashed runs can be resumed
+        workName = 'workJournal'
+        workColumns = {
+            'file_name' : 'TEXT',
+            'worker' : 'TEXT',
+            'path' : 'TEXT',
+            'datasets' : 'TEXT',
+            'state' : 'TEXT',
+            'attempts' : 'INTEGER',
+            'error' : 'TEXT',
+            'started' : 'REAL',
+            'finished' : 'REAL',
+            'seconds' : 'REAL',
+        }
+        workUnique = ['file_name']
+        # shards of a ShardedLogMonitorAPI catalog, with the range of dataset names each one holds
+        shardName = 'shardCatalog'
+        shardColumns = {
+            'shard' : 'TEXT',
+            'path' : 'TEXT',
+            'first_dataset' : 'TEXT',
+            'last_dataset' : 'TEXT',
+            'created' : 'INTEGER',
+        }
+        shardUnique = ['shard']
+        isNew = not os.path.isfile(self.sqlfile)
+        if readonly:
+            # never create or change the database, reads use their own connections
+            if isNew: raise IOError('{0} does not exist'.format(self.sqlfile))
+            self.readonly = True
+        if catalog:
+            # no layout, the catalog holds no files or counts
+            self.layout = None
+            tables = [metaName,workName,shardName]
+        else:
+            detected = 'normalized' if not isNew and self.__exists('logCounts') else 'flat'
+            if isNew: detected = layout or 'normalized'
+            if layout and layout!=detected:
+                raise ValueError('{0} has the {1} layout, use --migrate to convert it'.format(self.sqlfile,detected))
+            self.layout = detected
+            tables = [markName,summaryName,totalName,metaName,workName]
+        if self.readonly:
+            missing = [name for name in tables if not self.__exists(name)]
+            if missing:
+                raise ValueError('{0} has no {1} table, open it once without readonly to upgrade it'.format(self.sqlfile,', '.join(missing)))
+            self.close()
+            return
+        if catalog:
+            self.__create(metaName,*metaUnique,**metaColumns)
+            self.__create(workName,*workUnique,**workColumns)
+            self.__index(workName,'state')
+            self.__create(shardName,*shardUnique,**shardColumns)
+            return
+        if isNew and self.layout=='normalized':
+            self.__createNormalized(logIndices+fileIndices)
+        elif isNew:
             self.__create(logName,*logUnique,**logColumns)
             self.__create(fileName,*fileUnique,**fileColumns)
+        # tables added later, also created in existing databases
+        hasRollups = self.__exists(summaryName)
+        self.__create(markName,*markUnique,**markColumns)
+        self.__create(summaryName,*summaryUnique,**summaryColumns)
+        self.__create(totalName,*totalUnique,**totalColumns)
+        self.__create(metaName,*metaUnique,**metaColumns)
+        self.__create(workName,*workUnique,**workColumns)
+        self.__index(workName,'state')
+        if not isNew and not hasRollups:
+            self.rebuildRollups()
+        # secondary indices, also added to databases created before they existed
+        if self.layout=='flat':
+            for col in logIndices:
+                self.__index(logName,col)
+            for col in fileIndices:
+                self.__index(fileName,col)
+
+    # connection and transaction depth of the current thread
+    @property
+    def conn(self):
+        return getattr(self.local,'conn',None)
+
+    @conn.setter
+    def conn(self,conn):
+        self.local.conn = conn
+
+    @property
+    def depth(self):
+        return getattr(self.local,'depth',0)
 
-    def __execute(self,command):
+    @depth.setter
+    def depth(self,depth):
+        self.local.depth = depth
+
+    def __connect(self):
+        '''Open the long-lived connection of this thread on first use'''
+        if self.conn is None:
+            # transactions are managed explicitly in transaction()
+            conn = sqlite3.connect(self.sqlfile,isolation_level=None)
+            if self.readonly:
+                conn.set_authorizer(readOnlyAuthorizer)
+            else:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn = conn
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    @contextmanager
+    def transaction(self):
+        '''Group all writes in the block into one atomic commit'''
+        conn = self.__connect()
+        if not self.depth: conn.execute('BEGIN')
+        self.depth += 1
+        try:
+            yield self
+        except:
+            self.depth -= 1
+            if not self.depth: conn.execute('ROLLBACK')
+            raise
+        self.depth -= 1
+        if not self.depth: conn.execute('COMMIT')
+
+    def __execute(self,command,params=()):
         logging.debug(command)
-        conn = sqlite3.connect(self.sqlfile)
+        conn = self.__connect()
         c = conn.cursor()
-        c.execute(command)
-        conn.commit()
-        conn.close()
+        c.execute(command,params)
 
-    def __executeReturn(self,command):
+    def __executeMany(self,command,rows):
         logging.debug(command)
-        conn = sqlite3.connect(self.sqlfile)
+        conn = self.__connect()
         c = conn.cursor()
-        c.execute(command)
+        c.executemany(command,rows)
+
+    def __executeReturn(self,command,params=()):
+        logging.debug('{0} {1}'.format(command,params))
+        conn = self.__connect()
+        c = conn.cursor()
+        if self.explain:
+            c.execute('EXPLAIN QUERY PLAN {0}'.format(command),params)
+            for row in c.fetchall():
+                logging.info('QUERY PLAN: {0}'.format(row[-1]))
+        c.execute(command,params)
         result = c.fetchall()
-        conn.close()
         return result
 
+    def __executeBatches(self,command,params=(),batchSize=100000):
+        '''Yield the result rows in lists of batchSize rows'''
+        logging.debug('{0} {1}'.format(command,params))
+        conn = self.__connect()
+        c = conn.cursor()
+        c.execute(command,params)
+        while True:
+            rows = c.fetchmany(batchSize)
+            if not rows: break
+            yield rows
+
     def __create(self,tableName,*unique,**columns):
-        command = 'CREATE TABLE {table} ({columns}, UNIQUE({unique}))'.format(
+        command = 'CREATE TABLE IF NOT EXISTS {table} ({columns}, UNIQUE({unique}))'.format(
             table=tableName,
             columns=', '.join([' '.join([key,val]) for key,val in columns.iteritems()]),
             unique=', '.join(unique)
         )
         self.__execute(command)
 
+    def __exists(self,tableName):
+        result = self.__executeReturn("SELECT name FROM sqlite_master WHERE type='table' AND name=?",(tableName,))
+        return bool(result)
+
+    def __createNormalized(self,indices):
+        '''
+        Dictionary tables, WITHOUT ROWID fact tables keyed by the dictionary ids,
+        and views with the columns of the flat tables so all queries and inserts are unchanged.
+        Inserts into the views intern new strings through INSTEAD OF triggers.
+        '''
+        dictionaries = dict(DICTIONARIES)
+        for col,table in DICTIONARIES:
+            self.__create(table,'name',id='INTEGER PRIMARY KEY',name='TEXT NOT NULL')
+        for view,facts,keys,values in FACTS:
+            ids = ['{0}_id'.format(key) for key in keys]
+            self.__execute('CREATE TABLE IF NOT EXISTS {facts} ({columns}, PRIMARY KEY ({ids})) WITHOUT ROWID'.format(
+                facts=facts,
+                columns=', '.join(['{0} INTEGER NOT NULL'.format(i) for i in ids]+['{0} INTEGER'.format(v) for v in values]),
+                ids=', '.join(ids),
+            ))
+            for key in keys:
+                if key in indices: self.__index(facts,'{0}_id'.format(key))
+            self.__execute('CREATE VIEW IF NOT EXISTS {view} AS SELECT {columns} FROM {facts} t {joins}'.format(
+                view=view,
+                columns=', '.join(['d{0}.name AS {1}'.format(k,key) for k,key in enumerate(keys)]+['t.{0} AS {0}'.format(v) for v in values]),
+                facts=facts,
+                joins=' '.join(['JOIN {0} d{1} ON d{1}.id=t.{2}_id'.format(dictionaries[key],k,key) for k,key in enumerate(keys)]),
+            ))
+            self.__execute('CREATE TRIGGER IF NOT EXISTS {view}_insert INSTEAD OF INSERT ON {view} BEGIN {interns} INSERT INTO {facts} ({columns}) VALUES ({values}); END'.format(
+                view=view,
+                interns=' '.join(['INSERT OR IGNORE INTO {0} (name) VALUES (NEW.{1});'.format(dictionaries[key],key) for key in keys]),
+                facts=facts,
+                columns=', '.join(ids+values),
+                values=', '.join(['(SELECT id FROM {0} WHERE name=NEW.{1})'.format(dictionaries[key],key) for key in keys]+['NEW.{0}'.format(v) for v in values]),
+            ))
+
+    def __index(self,tableName,*columns):
+        command = 'CREATE INDEX IF NOT EXISTS {table}_{name} ON {table} ({columns})'.format(
+            table=tableName,
+            name='_'.join(columns),
+            columns=', '.join(columns),
+        )
+        self.__execute(command)
+
     def __insert(self,tableName,**kwargs):
-        columns = []
-        values = []
-        for col,val in kwargs.iteritems():
-            columns += [col]
-            values += ["'{0}'".format(val) if isinstance(val,basestring) else "{0}".format(val)]
+        '''Insert a row, returns False if it violates a constraint'''
+        columns = sorted(kwargs.keys())
         command = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
             table=tableName,
             columns=', '.join(columns),
-            values=', '.join(values)
+            values=', '.join(['?']*len(columns))
         )
         try:
-            self.__execute(command)
+            self.__execute(command,[kwargs[col] for col in columns])
         except sqlite3.IntegrityError as e:
             logging.error(e)
+            return False
+        return True
 
-    def __select(self,tableName,*columns,**conditions):
+    def __upsertMany(self,view,rows):
+        '''
+        Insert a list of rows (dicts) into logMonitor or processedFiles, replacing the values of existing rows.
+        Normalized databases intern the strings first and upsert the fact table directly, views cannot be upsert targets.
+        '''
+        if not rows: return
+        dictionaries = dict(DICTIONARIES)
+        keys, values = [(k,v) for name,facts,k,v in FACTS if name==view][0]
+        if self.layout=='normalized':
+            facts = [f for name,f,k,v in FACTS if name==view][0]
+            conflict = ['{0}_id'.format(key) for key in keys]
+            placeholders = ['(SELECT id FROM {0} WHERE name=?)'.format(dictionaries[key]) for key in keys]
+        else:
+            facts = view
+            conflict = keys
+            placeholders = ['?']*len(keys)
+        command = 'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT ({conflict}) DO {update}'.format(
+            table=facts,
+            columns=', '.join(conflict+values),
+            values=', '.join(placeholders+['?']*len(values)),
+            conflict=', '.join(conflict),
+            update='UPDATE SET {0}'.format(', '.join(['{0}=excluded.{0}'.format(v) for v in values])) if values else 'NOTHING',
+        )
+        with self.transaction():
+            if self.layout=='normalized':
+                for key in keys:
+                    self.__executeMany('INSERT OR IGNORE INTO {0} (name) VALUES (?)'.format(dictionaries[key]),[[name] for name in set([row[key] for row in rows])])
+            self.__executeMany(command,[[row[col] for col in keys+values] for row in rows])
+
+    def __prefixEnd(self,prefix):
+        '''Smallest string greater than every string starting with prefix'''
+        maxchar = 0x10ffff if isinstance(prefix,unicode) else 0xff
+        tochar = unichr if isinstance(prefix,unicode) else chr
+        while prefix:
+            last = ord(prefix[-1])
+            if last < maxchar:
+                return prefix[:-1] + tochar(last+1)
+            prefix = prefix[:-1]
+        return None
+
+    def __range(self,column,prefix):
+        '''Range condition selecting all strings starting with prefix'''
+        end = self.__prefixEnd(prefix)
+        if end is None: return ['{0}>=?'.format(column)], [prefix]
+        return ['{0}>=?'.format(column), '{0}<?'.format(column)], [prefix,end]
+
+    def __condition(self,column,val):
+        '''
+        Translate a value with unix-like '*' wildcards into SQL conditions with bound parameters.
+        The literal part before the first wildcard becomes a range scan that can use the column index.
+        Matching is case-sensitive, unlike the LIKE based matching it replaced, so that the index can be used.
+        '''
+        if '*' not in val:
+            return ['{0}=?'.format(column)], [val]
+        prefix = val.split('*')[0]
+        conds, params = self.__range(column,prefix) if prefix else ([], [])
+        if val.rstrip('*') == prefix:
+            return conds, params
+        # escape the other GLOB metacharacters so only '*' is a wildcard
+        pattern = ''.join(['[{0}]'.format(c) if c in '?[' else c for c in val])
+        return conds + ['{0} GLOB ?'.format(column)], params + [pattern]
+
+    def __where(self,aliases=None,**conditions):
+        '''Build the WHERE clause and parameters, aliases maps a column to its qualified name'''
+        aliases = aliases or {}
         conds = []
-        for cond,val in conditions.iteritems():
-            if isinstance(val,basestring): conds += ["{0} LIKE '{1}'".format(cond,val.replace('*','%')) if '*' in val else "{0}='{1}'".format(cond,val)]
+        params = []
+        for cond,val in sorted(conditions.iteritems()):
+            column = aliases.get(cond,cond)
+            if isinstance(val,(list,tuple,set)):
+                # list of exact values
+                conds += ['{0} IN ({1})'.format(column,', '.join(['?']*len(val)))]
+                params += list(val)
+                continue
+            if not isinstance(val,basestring): continue
+            c, p = self.__condition(column,val)
+            conds += c
+            params += p
+        if not conds: return '', params
+        return ' WHERE {conditions}'.format(conditions=' AND '.join(conds)), params
+
+    def __select(self,tableName,*columns,**conditions):
         command = 'SELECT {columns} FROM {table}'.format(
             columns=', '.join(columns) if columns else '*',
             table=tableName,
         )
-        if conds:
-            command += ' WHERE {conditions}'.format(
-                conditions=' AND '.join(conds)
-            )
-        result = self.__executeReturn(command)
+        where, params = self.__where(**conditions)
+        command += where
+        result = self.__executeReturn(command,params)
         return result
+
+    def __allowedFiles(self,file_names):
+        '''Load a temporary table of file names to join against'''
+        self.__execute('CREATE TEMP TABLE IF NOT EXISTS allowedFiles (file_name TEXT PRIMARY KEY)')
+        with self.transaction():
+            self.__execute('DELETE FROM allowedFiles')
+            self.__executeMany('INSERT OR IGNORE INTO allowedFiles (file_name) VALUES (?)',[[f] for f in file_names])
+        return 'allowedFiles'
         
     def __wrapResult(self,columns,result):
         newresult = []
@@ -100,8 +445,161 @@ class LogMonitorAPI(object):
     def insertModule(self,**kwargs):
         self.__insert('logMonitor',**kwargs)
 
+    def insertModules(self,rows):
+        '''
+        Insert a list of logMonitor rows (dicts) with a single executemany.
+        Existing rows of the same file, module, log_key, severity get the new count, so a file can be ingested again.
+        '''
+        self.__upsertMany('logMonitor',rows)
+
+    def insertDatasetMark(self,dataset,nfiles,last_modified=0):
+        '''Record the high-water mark of a dataset, replacing the previous one'''
+        command = 'INSERT OR REPLACE INTO datasetMarks (dataset, nfiles, last_modified) VALUES (?, ?, ?)'
+        self.__execute(command,(dataset,nfiles,last_modified))
+
     def insertProcessedFile(self,**kwargs):
-        self.__insert('processedFiles',**kwargs)
+        '''
+        Mark a file processed and add its logMonitor rows to the dataset rollups in the same transaction.
+        The logMonitor rows of the file must be inserted first.
+        '''
+        with self.transaction():
+            if self.__insert('processedFiles',**kwargs):
+                self.__rollupFile(kwargs['file_name'],kwargs['dataset'])
+                self.bumpGeneration()
+
+    def queueWork(self,tasks):
+        '''Record files as pending in the work journal, tasks are dicts with file_name, worker, path and datasets'''
+        command = ("INSERT INTO workJournal (file_name, worker, path, datasets, state, attempts) VALUES (?, ?, ?, ?, 'pending', 0) "
+                   "ON CONFLICT (file_name) DO UPDATE SET worker=excluded.worker, path=excluded.path, datasets=excluded.datasets, state='pending'")
+        with self.transaction():
+            self.__executeMany(command,[(t['file_name'],t['worker'],t['path'],' '.join(t['datasets'])) for t in tasks])
+
+    def startWork(self,file_name,worker,path,datasets):
+        '''Mark a file running in the work journal and count the attempt'''
+        command = ("INSERT INTO workJournal (file_name, worker, path, datasets, state, attempts, error, started) VALUES (?, ?, ?, ?, 'running', 1, '', ?) "
+                   "ON CONFLICT (file_name) DO UPDATE SET worker=excluded.worker, path=excluded.path, datasets=excluded.datasets, "
+                   "state='running', attempts=attempts+1, error='', started=excluded.started, finished=NULL, seconds=NULL")
+        self.__execute(command,(file_name,worker,path,' '.join(datasets),time.time()))
+
+    def finishWork(self,file_name,error=''):
+        '''Mark a file done, or failed if there is an error, in the work journal'''
+        now = time.time()
+        command = 'UPDATE workJournal SET state=?, error=?, finished=?, seconds=?-started WHERE file_name=?'
+        self.__execute(command,('failed' if error else 'done',error,now,now,file_name))
+
+    def insertShard(self,shard,path,dataset):
+        '''Record a shard in the catalog, widening its dataset boundaries to include dataset'''
+        command = ('INSERT INTO shardCatalog (shard, path, first_dataset, last_dataset, created) VALUES (?, ?, ?, ?, ?) '
+                   'ON CONFLICT (shard) DO UPDATE SET first_dataset=min(first_dataset,excluded.first_dataset), last_dataset=max(last_dataset,excluded.last_dataset)')
+        self.__execute(command,(shard,path,dataset,dataset,int(time.time())))
+
+    def bumpGeneration(self):
+        '''Signal readers that cached results are stale'''
+        command = ("INSERT INTO metadata (key, value) VALUES ('generation', 1) "
+                   "ON CONFLICT (key) DO UPDATE SET value=value+1")
+        self.__execute(command)
+
+    def setMetadata(self,key,value):
+        self.__execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',(key,value))
+
+    def __rollupFile(self,file_name,dataset):
+        command = ('INSERT INTO datasetSummary (dataset, severity, log_key, module, count) '
+                   'SELECT ?, severity, log_key, module, count FROM logMonitor WHERE file_name=? '
+                   'ON CONFLICT (dataset, severity, log_key, module) DO UPDATE SET count=count+excluded.count')
+        self.__execute(command,(dataset,file_name))
+        command = ('INSERT INTO datasetTotals (dataset, nfiles) VALUES (?, 1) '
+                   'ON CONFLICT (dataset) DO UPDATE SET nfiles=nfiles+1')
+        self.__execute(command,(dataset,))
+
+    def migrate(self,sqlfile,datasets=None):
+        '''
+        Copy the processed files and log counts of another database into this one and rebuild the rollups.
+        datasets restricts the copy to those datasets and the log counts of their files,
+        otherwise the work journal and the metadata are copied as well.
+        '''
+        logging.info('Migrating {0} to the {1} layout of {2}'.format(sqlfile,self.layout,self.sqlfile))
+        # databases cannot be attached inside a transaction
+        self.__execute('ATTACH DATABASE ? AS old',(sqlfile,))
+        hasMarks = self.__executeReturn("SELECT name FROM old.sqlite_master WHERE type='table' AND name='datasetMarks'")
+        sources = dict([(view,'old.{0}'.format(view)) for view in ['logMonitor','processedFiles','datasetMarks']])
+        if datasets is not None:
+            # temporary views selecting the rows of the datasets from the attached database
+            self.__execute('CREATE TEMP TABLE migrateDatasets (dataset TEXT PRIMARY KEY)')
+            self.__executeMany('INSERT OR IGNORE INTO migrateDatasets (dataset) VALUES (?)',[[ds] for ds in datasets])
+            self.__execute('CREATE TEMP VIEW migrateProcessedFiles AS SELECT * FROM old.processedFiles WHERE dataset IN (SELECT dataset FROM migrateDatasets)')
+            self.__execute('CREATE TEMP VIEW migrateLogMonitor AS SELECT * FROM old.logMonitor WHERE file_name IN (SELECT file_name FROM migrateProcessedFiles)')
+            sources = {'logMonitor':'migrateLogMonitor','processedFiles':'migrateProcessedFiles'}
+            if hasMarks:
+                self.__execute('CREATE TEMP VIEW migrateMarks AS SELECT * FROM old.datasetMarks WHERE dataset IN (SELECT dataset FROM migrateDatasets)')
+                sources['datasetMarks'] = 'migrateMarks'
+        try:
+            with self.transaction():
+                if self.layout=='normalized':
+                    self.__migrateNormalized(sources)
+                else:
+                    for view,facts,keys,values in FACTS:
+                        columns = ', '.join(keys+values)
+                        self.__execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(view,columns,sources[view]))
+                if hasMarks:
+                    self.__execute('INSERT OR REPLACE INTO datasetMarks (dataset, nfiles, last_modified) SELECT dataset, nfiles, last_modified FROM {0}'.format(sources['datasetMarks']))
+                if datasets is None:
+                    self.__copyState()
+                self.rebuildRollups()
+        finally:
+            if datasets is not None:
+                for view in ['migrateMarks','migrateLogMonitor','migrateProcessedFiles']:
+                    self.__execute('DROP VIEW IF EXISTS temp.{0}'.format(view))
+                self.__execute('DROP TABLE temp.migrateDatasets')
+            self.__execute('DETACH DATABASE old')
+
+    def migrateState(self,sqlfile):
+        '''Copy the work journal and the metadata of another database into this one'''
+        self.__execute('ATTACH DATABASE ? AS old',(sqlfile,))
+        try:
+            with self.transaction():
+                self.__copyState()
+        finally:
+            self.__execute('DETACH DATABASE old')
+
+    def __copyState(self):
+        '''Copy the work journal and the metadata of the attached database, metadata keeps the larger value of each key'''
+        tables = set([row[0] for row in self.__executeReturn("SELECT name FROM old.sqlite_master WHERE type='table'")])
+        if 'workJournal' in tables:
+            columns = 'file_name, worker, path, datasets, state, attempts, error, started, finished, seconds'
+            self.__execute('INSERT OR REPLACE INTO workJournal ({0}) SELECT {0} FROM old.workJournal'.format(columns))
+        if 'metadata' in tables:
+            # WHERE true keeps the ON CONFLICT clause from being parsed as a join constraint
+            self.__execute('INSERT INTO metadata (key, value) SELECT key, value FROM old.metadata WHERE true '
+                           'ON CONFLICT (key) DO UPDATE SET value=max(value,excluded.value)')
+
+    def __migrateNormalized(self,sources):
+        '''Bulk copy into the normalized tables, interning all strings before the fact rows are inserted in key order'''
+        dictionaries = dict(DICTIONARIES)
+        for col,table in DICTIONARIES:
+            selects = ' UNION '.join(['SELECT {0} FROM {1}'.format(col,sources[view]) for view,facts,keys,values in FACTS if col in keys])
+            self.__execute('INSERT OR IGNORE INTO {0} (name) {1}'.format(table,selects))
+        for view,facts,keys,values in FACTS:
+            ids = ['d{0}.id'.format(k) for k in range(len(keys))]
+            self.__execute('INSERT INTO {facts} ({columns}) SELECT {values} FROM {source} o {joins} ORDER BY {ids}'.format(
+                facts=facts,
+                columns=', '.join(['{0}_id'.format(key) for key in keys]+values),
+                values=', '.join(ids+['o.{0}'.format(v) for v in values]),
+                source=sources[view],
+                joins=' '.join(['JOIN {0} d{1} ON d{1}.name=o.{2}'.format(dictionaries[key],k,key) for k,key in enumerate(keys)]),
+                ids=', '.join(ids),
+            ))
+
+    def rebuildRollups(self):
+        '''Recompute the dataset rollups from the processed files'''
+        logging.info('Rebuilding dataset rollups of {0}'.format(self.sqlfile))
+        with self.transaction():
+            self.__execute('DELETE FROM datasetSummary')
+            self.__execute('DELETE FROM datasetTotals')
+            self.__execute('INSERT INTO datasetSummary (dataset, severity, log_key, module, count) '
+                           'SELECT p.dataset, l.severity, l.log_key, l.module, SUM(l.count) FROM processedFiles p JOIN logMonitor l ON l.file_name=p.file_name '
+                           'GROUP BY p.dataset, l.severity, l.log_key, l.module')
+            self.__execute('INSERT INTO datasetTotals (dataset, nfiles) SELECT dataset, COUNT(*) FROM processedFiles GROUP BY dataset')
+            self.bumpGeneration()
 
     ##################
     ### query data ###
@@ -116,16 +614,193 @@ class LogMonitorAPI(object):
         result = self.__select('processedFiles',*columns,**kwargs)
         return self.__wrapResult(columns,result)
 
+    def listWork(self,**kwargs):
+        '''Work journal entries, accepts conditions on file_name, worker, state, datasets is returned as a list'''
+        columns = ['file_name', 'worker', 'path', 'datasets', 'state', 'attempts', 'error', 'started', 'finished', 'seconds']
+        result = self.__wrapResult(columns,self.__select('workJournal',*columns,**kwargs))
+        for row in result:
+            row['datasets'] = row['datasets'].split() if row['datasets'] else []
+        return result
+
+    def listShards(self,**kwargs):
+        columns = ['shard', 'path', 'first_dataset', 'last_dataset', 'created']
+        result = self.__select('shardCatalog',*columns,**kwargs)
+        return self.__wrapResult(columns,result)
+
+    def getGeneration(self):
+        return self.getMetadata('generation')
+
+    def getMetadata(self,key,default=0):
+        result = self.__executeReturn('SELECT value FROM metadata WHERE key=?',(key,))
+        return result[0][0] if result else default
+
+    def getProcessedFileNames(self,**kwargs):
+        '''Set of processed file names, loaded with a single query'''
+        return set([r[0] for r in self.__select('processedFiles','file_name',**kwargs)])
+
+    def listDatasetMarks(self,**kwargs):
+        columns = ['dataset','nfiles','last_modified']
+        result = self.__select('datasetMarks',*columns,**kwargs)
+        return self.__wrapResult(columns,result)
+
+    def __ranking(self,columns,order_by=None,descending=True,limit=None,offset=0):
+        '''ORDER BY and LIMIT clauses and parameters, order_by must be one of the columns'''
+        command = ''
+        params = []
+        if order_by:
+            if order_by not in columns: raise ValueError('Cannot order by {0}, valid columns are {1}'.format(order_by,columns))
+            direction = 'DESC' if descending else 'ASC'
+            command += ' ORDER BY {0}'.format(', '.join(['{0} {1}'.format(order_by,direction)]+[c for c in columns if c!=order_by]))
+        if limit is not None or offset:
+            command += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
+        return command, params
+
+    def summarizeDatasets(self,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+        '''Same as summarize without a file selection, read from the dataset rollups'''
+        groups = ['severity', 'log_key', 'module'] if merge_datasets else ['dataset', 'severity', 'log_key', 'module']
+        columns = groups + ['count']
+        command = 'SELECT {0}, SUM(count) AS count FROM datasetSummary'.format(', '.join(groups))
+        where, params = self.__where(**kwargs)
+        command += where
+        command += ' GROUP BY {0}'.format(', '.join(groups))
+        ranking, rankParams = self.__ranking(columns,order_by,descending,limit,offset)
+        result = self.__executeReturn(command+ranking,params+rankParams)
+        return self.__wrapResult(columns,result)
+
+    def compareDatasets(self,baseline,target,normalize='file',order_by='score',descending=True,limit=None,offset=0,**kwargs):
+        '''
+        Compare the counts of two dataset patterns per severity, log_key, module in a single query over the dataset rollups.
+        normalize='file' divides the counts by the number of processed files of each side, 'none' compares the raw counts.
+        Each row has the counts and rates of both sides, delta and ratio of the rates (ratio is None for new entries),
+        and score, the squared significance of the delta assuming Poisson counts.
+        Accepts conditions on module, log_key, severity, ordered by score by default.
+        '''
+        if normalize not in ['file','none']:
+            raise ValueError('Cannot normalize per {0}, valid choices are file and none (event counts are not stored)'.format(normalize))
+        base, baseParams = self.__condition('dataset',baseline)
+        targ, targParams = self.__condition('dataset',target)
+        base = ' AND '.join(base) or '1'
+        targ = ' AND '.join(targ) or '1'
+        if normalize=='file':
+            totals = self.__executeReturn('SELECT SUM(CASE WHEN {0} THEN nfiles ELSE 0 END), SUM(CASE WHEN {1} THEN nfiles ELSE 0 END) FROM datasetTotals'.format(base,targ),baseParams+targParams)
+            baseFiles, targetFiles = totals[0]
+            if not baseFiles or not targetFiles:
+                raise ValueError('No processed files match {0}'.format(baseline if not baseFiles else target))
+        else:
+            baseFiles, targetFiles = 1, 1
+        columns = ['severity', 'log_key', 'module', 'base_count', 'target_count', 'base_rate', 'target_rate', 'delta', 'ratio', 'score']
+        where, params = self.__where(**dict([(key,val) for key,val in kwargs.iteritems() if key!='dataset']))
+        where = ' AND ({0})'.format(where[len(' WHERE '):]) if where else ''
+        command = ('SELECT severity, log_key, module, base_count, target_count, base_rate, target_rate, '
+                   'target_rate-base_rate AS delta, '
+                   'CASE WHEN base_rate>0 THEN target_rate/base_rate END AS ratio, '
+                   '(target_rate-base_rate)*(target_rate-base_rate)/(1.0*target_count/(?*?)+1.0*base_count/(?*?)) AS score '
+                   'FROM (SELECT severity, log_key, module, base_count, target_count, 1.0*base_count/? AS base_rate, 1.0*target_count/? AS target_rate '
+                   'FROM (SELECT severity, log_key, module, '
+                   'SUM(CASE WHEN {base} THEN count ELSE 0 END) AS base_count, '
+                   'SUM(CASE WHEN {targ} THEN count ELSE 0 END) AS target_count '
+                   'FROM datasetSummary WHERE (({base}) OR ({targ})){where} '
+                   'GROUP BY severity, log_key, module))').format(base=base,targ=targ,where=where)
+        params = [targetFiles,targetFiles,baseFiles,baseFiles,baseFiles,targetFiles] + baseParams + targParams + baseParams + targParams + params
+        ranking, rankParams = self.__ranking(columns,order_by,descending,limit,offset)
+        result = self.__executeReturn(command+ranking,params+rankParams)
+        return self.__wrapResult(columns,result)
+
+    def listDatasetTotals(self,**kwargs):
+        columns = ['dataset','nfiles']
+        result = self.__select('datasetTotals',*columns,**kwargs)
+        return self.__wrapResult(columns,result)
+
+    def listDatasets(self,**kwargs):
+        columns = ['dataset']
+        result = self.__select('processedFiles','DISTINCT dataset',**kwargs)
+        return self.__wrapResult(columns,result)
+
+    def iterProcessedRows(self,batchSize=100000,**kwargs):
+        '''
+        Yield the log counts of the processed files with their dataset in lists of (dataset, file_name, severity, log_key, module, count) tuples.
+        Accepts the same conditions as summarize, rows are ordered by dataset and file.
+        '''
+        aliases = {
+            'dataset'   : 'p.dataset',
+            'file_name' : 'p.file_name',
+            'module'    : 'l.module',
+            'log_key'   : 'l.log_key',
+            'severity'  : 'l.severity',
+        }
+        command = 'SELECT p.dataset, p.file_name, l.severity, l.log_key, l.module, l.count FROM processedFiles p JOIN logMonitor l ON l.file_name=p.file_name'
+        where, params = self.__where(aliases,**kwargs)
+        command += where
+        command += ' ORDER BY p.dataset, p.file_name'
+        return self.__executeBatches(command,params,batchSize)
+
+    def summarize(self,file_names=None,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+        '''
+        Sum the counts of processed files per dataset, severity, log_key, module in a single query.
+        Accepts conditions on dataset, file_name, module, log_key, severity.
+        If file_names is given only those files are included.
+        merge_datasets sums over the datasets, order_by (one of the columns), limit and offset are applied in the query.
+        '''
+        aliases = {
+            'dataset'   : 'p.dataset',
+            'file_name' : 'p.file_name',
+            'module'    : 'l.module',
+            'log_key'   : 'l.log_key',
+            'severity'  : 'l.severity',
+        }
+        groups = ['severity', 'log_key', 'module'] if merge_datasets else ['dataset', 'severity', 'log_key', 'module']
+        columns = groups + ['count']
+        command = 'SELECT {0}, SUM(l.count) AS count FROM processedFiles p JOIN logMonitor l ON l.file_name=p.file_name'.format(
+            ', '.join(['{0} AS {1}'.format(aliases[g],g) for g in groups]),
+        )
+        if file_names is not None:
+            command += ' JOIN {0} a ON a.file_name=p.file_name'.format(self.__allowedFiles(file_names))
+        where, params = self.__where(aliases,**kwargs)
+        command += where
+        command += ' GROUP BY {0}'.format(', '.join([aliases[g] for g in groups]))
+        ranking, rankParams = self.__ranking(columns,order_by,descending,limit,offset)
+        result = self.__executeReturn(command+ranking,params+rankParams)
+        return self.__wrapResult(columns,result)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='LogMonitor database API, runs the unit tests by default')
+
+    parser.add_argument('--rebuild', type=str, default='', help='Rebuild the dataset rollup tables of this database')
+    parser.add_argument('--migrate', type=str, nargs=2, metavar=('OLD','NEW'), help='Copy database OLD into a new database NEW with the --layout')
+    parser.add_argument('--layout', type=str, default='normalized', choices=LAYOUTS, help='Layout of new databases')
+
+    return parser.parse_args(argv)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
+    args = parse_command_line(argv)
+
+    if args.rebuild:
+        api = LogMonitorAPI(args.rebuild)
+        api.rebuildRollups()
+        return
+
+    if args.migrate:
+        old, new = args.migrate
+        if not os.path.isfile(old):
+            logging.error('{0} does not exist'.format(old))
+            return 1
+        if os.path.exists(new):
+            logging.error('{0} already exists'.format(new))
+            return 1
+        api = LogMonitorAPI(new,layout=args.layout)
+        api.migrate(old)
+        return
+
     logging.getLogger().setLevel(logging.DEBUG)
 
     # simple setup
     sqlfile = 'test.sqlite'
     if os.path.exists(sqlfile): os.remove(sqlfile)
-    api = LogMonitorAPI(sqlfile)
+    api = LogMonitorAPI(sqlfile,layout=args.layout)
     api.insertModule(file_name='dummy',module='mod1',severity='INFO',count=1,log_key='ModErrorType')
     api.insertModule(file_name='dummy',module='mod2',severity='WARNING',count=2,log_key='ModErrorType')
     api.insertProcessedFile(file_name='dummy',dataset='/a/b/c')
@@ -133,8 +808,65 @@ def main(argv=None):
     # attempt to insert duplicate
     api.insertModule(file_name='dummy',module='mod1',severity='INFO',count=1,log_key='ModErrorType')
 
+    # batched insert committed together with the processed file
+    with api.transaction():
+        api.insertModules([
+            {'file_name':'dummy2','module':'mod1','severity':'INFO','count':3,'log_key':'ModErrorType'},
+            {'file_name':'dummy2','module':'mod3','severity':'WARNING','count':4,'log_key':'OtherErrorType'},
+        ])
+        api.insertProcessedFile(file_name='dummy2',dataset='/a/b/c')
+
+    # ingesting a file again updates its rows instead of failing
+    api.insertModules([
+        {'file_name':'dummy2','module':'mod1','severity':'INFO','count':3,'log_key':'ModErrorType'},
+    ])
+
+    # work journal
+    api.queueWork([{'file_name':'dummy4','worker':'dataWorker','path':'root://dummy4','datasets':['/a/b/c']}])
+    api.startWork('dummy4','dataWorker','root://dummy4',['/a/b/c'])
+    api.finishWork('dummy4','IOError: simulated timeout')
+    api.startWork('dummy4','dataWorker','root://dummy4',['/a/b/c'])
+    print api.listWork(state=['running','failed'])
+
+    # failed transaction leaves nothing behind
+    try:
+        with api.transaction():
+            api.insertModule(file_name='dummy3',module='mod1',severity='INFO',count=1,log_key='ModErrorType')
+            raise RuntimeError('simulated crash')
+    except RuntimeError as e:
+        logging.info(e)
+
+    # wildcard queries
+    api.explain = True
+    print api.listModules(module='mod*')
+    print api.listModules(log_key='*Other*')
+    print api.listProcessedFiles(dataset='/a/*/c')
+    print api.summarize(dataset='/a/*',module='mod*')
+    print api.summarize(file_names=['dummy2'])
+    api.explain = False
+
+    # rollups match the aggregation over the files
+    print api.summarizeDatasets(dataset='/a/*')
+    print api.listDatasetTotals()
+    api.rebuildRollups()
+    print api.summarizeDatasets(dataset='/a/*')
+
+    print api.getGeneration()
+
+    # top-N in the query
+    print api.summarize(order_by='count',limit=2)
+    print api.summarizeDatasets(merge_datasets=True,order_by='count',limit=1,offset=1)
+
+    # high-water marks
+    api.insertDatasetMark('/a/b/c',2)
+    api.insertDatasetMark('/a/b/c',3,1476000000)
+    print api.listDatasetMarks(dataset='/a/b/c')
+    print api.getProcessedFileNames(dataset=['/a/b/c','/d/e/f'])
+
     # query test
     print api.listModules(file_name='dummy')
+    print api.listModules(file_name='dummy2')
+    print api.listModules(file_name='dummy3')
     print api.listProcessedFiles(dataset='/a/b/c')
 
 if __name__ == "__main__":
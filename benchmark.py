@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import json
+import random
+import logging
+import argparse
+import tempfile
+import tarfile
+import shutil
+import subprocess
+from collections import Counter
+
+from logParser import parseLogFile, readLines, readLogCollect
+from LogMonitorAPI import LogMonitorAPI, LAYOUTS
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+CATEGORIES = ['TooManyTracks','PFTrackTransformer','HLTConfigProvider','DTDigiReader','L1GtUtils','BadMuon','MemoryCheck']
+MODULES = ['PFProducer:particleFlowTmp','TrackProducer:generalTracks','HLTPrescaleRecorder:hltPrescaleRecorder','MuonIdProducer:muons1stStep','CkfTrackCandidateMaker:initialStepTrackCandidates']
+
+def makeStdout(fileobj,size,errors=0.01,warnings=0.05,seed=0):
+    '''Write about size bytes of synthetic cmsRun stdout with the given fraction of MSG-e and MSG-w messages'''
+    rng = random.Random(seed)
+    written = 0
+    event = 0
+    while written < size:
+        event += 1
+        r = rng.random()
+        if r < errors+warnings:
+            sev = 'e' if r < errors else 'w'
+            lines = [
+                '%MSG-{0} {1}:  {2} 18-Oct-2026 12:00:00 CEST Run: 1 Event: {3}\n'.format(sev,rng.choice(CATEGORIES),rng.choice(MODULES),event),
+                'Synthetic message body for event {0}\n'.format(event),
+                '%MSG\n',
+            ]
+        else:
+            lines = ['Begin processing the {0}th record. Run 1, Event {0}, LumiSection 1 on stream 0 at 18-Oct-2026 12:00:00.000 CEST\n'.format(event)]
+        chunk = ''.join(lines)
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
+
+def makeLogCollect(path,njobs,size,errors=0.01,warnings=0.05,seed=0):
+    '''
+    Write a LogCollect tarball like the ones of a relval request:
+    an outer tar holding one tar.gz with a stdout log of about size bytes per job.
+    Returns the total size of the logs.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        written = 0
+        inner = os.path.join(tmpdir,'logs.tar.gz')
+        with tarfile.open(inner,'w:gz') as tfg:
+            for job in range(njobs):
+                log = os.path.join(tmpdir,'cmsRun{0}-stdout.log'.format(job))
+                with open(log,'wb') as f:
+                    written += makeStdout(f,size,errors=errors,warnings=warnings,seed=seed+job)
+                tfg.add(log,arcname='job{0}/cmsRun1/cmsRun1-stdout.log'.format(job))
+                os.remove(log)
+        with tarfile.open(path,'w') as tf:
+            tf.add(inner,arcname='LogCollect-logs.tar.gz')
+    finally:
+        shutil.rmtree(tmpdir)
+    return written
+
+def makeRows(nrows,rowsPerFile=100,ndatasets=10,seed=0):
+    '''
+    Yield (file_name, dataset, rows) for nrows synthetic logMonitor rows,
+    each file has rowsPerFile distinct (severity, log_key, module) entries.
+    '''
+    rng = random.Random(seed)
+    log_keys = CATEGORIES+['Category{0}'.format(i) for i in range(50)]
+    modules = MODULES+['Producer{0}:module{0}'.format(i) for i in range(200)]
+    combinations = [(sev,lk,mod) for sev in ['Error','Warning'] for lk in log_keys for mod in modules]
+    nfiles = max(1,nrows//rowsPerFile)
+    for i in range(nfiles):
+        dataset = '/Primary{0}/Run2026A-LogErrorMonitor-v1/USER'.format(i%ndatasets)
+        file_name = '/store/user/logmonitor/Primary{0}/{1:09d}.root'.format(i%ndatasets,i)
+        rows = [{'file_name':file_name,'severity':sev,'log_key':lk,'module':mod,'count':rng.randint(1,1000)} for sev,lk,mod in rng.sample(combinations,min(rowsPerFile,nrows))]
+        yield file_name, dataset, rows
+
+def makeDatabase(lmclient,nrows,rowsPerFile=100,ndatasets=10,seed=0):
+    '''Fill a database with nrows synthetic rows, each file is committed together with its processed marker like logMonitor.py does'''
+    nfiles = 0
+    for file_name, dataset, rows in makeRows(nrows,rowsPerFile,ndatasets,seed):
+        with lmclient.transaction():
+            lmclient.insertModules(rows)
+            lmclient.insertProcessedFile(file_name=file_name,dataset=dataset)
+        nfiles += 1
+    return nfiles
+
+def timeit(func,*args,**kwargs):
+    start = time.time()
+    result = func(*args,**kwargs)
+    return time.time()-start, result
+
+def countLines(path):
+    nlines = 0
+    with open(path,'rb') as f:
+        for line in readLines(f):
+            nlines += 1
+    return nlines
+
+def benchParse(args):
+    '''Time parseLogFile over a synthetic stdout log'''
+    path = args.file
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='-stdout.log')
+        with os.fdopen(fd,'wb') as f:
+            logging.info('Writing {0} MB synthetic log to {1}'.format(args.size,path))
+            makeStdout(f,args.size*1024*1024,errors=args.errors,warnings=args.warnings)
+    try:
+        nbytes = os.path.getsize(path)
+        nlines = countLines(path)
+        with open(path,'rb') as f:
+            elapsed, results = timeit(parseLogFile,Counter(),readLines(f))
+    finally:
+        if not args.file: os.remove(path)
+    return {
+        'benchmark' : 'parse',
+        'bytes' : nbytes,
+        'lines' : nlines,
+        'messages' : sum(results.values()),
+        'keys' : len(results),
+        'seconds' : elapsed,
+        'bytes_per_second' : nbytes/elapsed if elapsed else 0,
+        'lines_per_second' : nlines/elapsed if elapsed else 0,
+    }
+
+def benchLogCollect(args):
+    '''Time readLogCollect over a synthetic LogCollect tarball'''
+    fd, path = tempfile.mkstemp(suffix='-LogCollect.tar')
+    os.close(fd)
+    try:
+        logging.info('Writing {0} jobs of {1} MB synthetic logs to {2}'.format(args.jobs,args.size,path))
+        nbytes = makeLogCollect(path,args.jobs,args.size*1024*1024,errors=args.errors,warnings=args.warnings)
+        elapsed, results = timeit(readLogCollect,path)
+        tarbytes = os.path.getsize(path)
+    finally:
+        os.remove(path)
+    return {
+        'benchmark' : 'logcollect',
+        'jobs' : args.jobs,
+        'bytes' : nbytes,
+        'tar_bytes' : tarbytes,
+        'messages' : sum(results.values()),
+        'keys' : len(results),
+        'seconds' : elapsed,
+        'bytes_per_second' : nbytes/elapsed if elapsed else 0,
+    }
+
+def benchDatabase(args):
+    '''Time the ingest, generateReport and the web table of synthetic databases of increasing size'''
+    import getReport
+    try:
+        import logMonitor_web
+    except ImportError as e:
+        logging.warning('Skipping the web table: {0}'.format(e))
+        logMonitor_web = None
+
+    results = []
+    cwd = os.getcwd()
+    for nrows in args.rows:
+        nrows = int(nrows)
+        tmpdir = args.directory or tempfile.mkdtemp()
+        if not os.path.isdir(tmpdir): os.makedirs(tmpdir)
+        # getReport always reads logMonitor.sqlite in the working directory
+        os.chdir(tmpdir)
+        try:
+            for suffix in ['','-wal','-shm']:
+                if os.path.exists('logMonitor.sqlite'+suffix): os.remove('logMonitor.sqlite'+suffix)
+            logging.info('Ingesting {0} rows in {1}'.format(nrows,tmpdir))
+            lmclient = LogMonitorAPI('logMonitor.sqlite',layout=args.layout)
+            ingest, nfiles = timeit(makeDatabase,lmclient,nrows,args.rows_per_file,args.datasets)
+            lmclient.close()
+            result = {
+                'benchmark' : 'database',
+                'rows' : nrows,
+                'layout' : args.layout,
+                'files' : nfiles,
+                'database_bytes' : os.path.getsize('logMonitor.sqlite'),
+                'ingest_seconds' : ingest,
+                'ingest_rows_per_second' : nrows/ingest if ingest else 0,
+            }
+            dataset = '/Primary0/Run2026A-LogErrorMonitor-v1/USER'
+            for name,query in [('all',{}),('dataset',{'dataset':dataset}),('module',{'module':'PFProducer*'})]:
+                elapsed, report = timeit(getReport.generateReport,**query)
+                result['report_{0}_seconds'.format(name)] = elapsed
+                result['report_{0}_bytes'.format(name)] = len(report)
+            if logMonitor_web:
+                summary = getReport.generateSummary()
+                elapsed, table = timeit(logMonitor_web.LogMonitor().makeTable,summary)
+                result['web_table_seconds'] = elapsed
+                result['web_table_bytes'] = len(table)
+            results += [result]
+        finally:
+            # the shared client still reads the database of this size
+            getReport.resetLogMonitorClients()
+            os.chdir(cwd)
+            if not args.directory: shutil.rmtree(tmpdir)
+    return results
+
+# commands whose start up time is measured, each in a fresh interpreter
+STARTUP_COMMANDS = [
+    ('import_logParser', ['-c','import logParser']),
+    ('import_logMonitor', ['-c','import logMonitor']),
+    ('import_getReport', ['-c','import getReport']),
+    ('help_logMonitor', ['logMonitor.py','--help']),
+    ('help_relval', ['logMonitor.py','relval','--help']),
+]
+
+def benchStartup(args):
+    '''Time the imports and --help of the tools in fresh interpreters, without ROOT or DBS nothing heavy should be loaded'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {'benchmark':'startup','repeat':args.repeat}
+    with open(os.devnull,'w') as devnull:
+        for name,command in STARTUP_COMMANDS:
+            times = []
+            for r in range(args.repeat):
+                start = time.time()
+                status = subprocess.call([sys.executable]+command,cwd=directory,stdout=devnull,stderr=devnull)
+                times += [time.time()-start]
+                if status: logging.warning('{0} exited with {1}'.format(' '.join(command),status))
+            times.sort()
+            results['{0}_seconds'.format(name)] = times[len(times)//2]
+            results['{0}_min_seconds'.format(name)] = times[0]
+    return results
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks for log monitoring')
+
+    subparsers = parser.add_subparsers(help='Benchmark to run')
+
+    parser_parse = subparsers.add_parser('parse', help='Parse a cmsRun stdout log')
+    parser_parse.add_argument('--file', type=str, default='', help='Existing stdout log to parse instead of a synthetic one')
+    parser_parse.add_argument('--size', type=int, default=1024, help='Size of the synthetic log in MB')
+    parser_parse.add_argument('--errors', type=float, default=0.01, help='Fraction of records that are MSG-e')
+    parser_parse.add_argument('--warnings', type=float, default=0.05, help='Fraction of records that are MSG-w')
+    parser_parse.set_defaults(submit=benchParse)
+
+    parser_logcollect = subparsers.add_parser('logcollect', help='Extract and parse a relval LogCollect tarball')
+    parser_logcollect.add_argument('--jobs', type=int, default=10, help='Number of job logs in the tarball')
+    parser_logcollect.add_argument('--size', type=int, default=10, help='Size of each synthetic log in MB')
+    parser_logcollect.add_argument('--errors', type=float, default=0.01, help='Fraction of records that are MSG-e')
+    parser_logcollect.add_argument('--warnings', type=float, default=0.05, help='Fraction of records that are MSG-w')
+    parser_logcollect.set_defaults(submit=benchLogCollect)
+
+    parser_database = subparsers.add_parser('database', help='Ingest, report and render synthetic databases')
+    parser_database.add_argument('--rows', type=float, nargs='+', default=[1e4,1e5,1e6], help='Number of logMonitor rows of each database')
+    parser_database.add_argument('--rows-per-file', type=int, default=100, help='Number of rows per processed file')
+    parser_database.add_argument('--datasets', type=int, default=10, help='Number of datasets the files are spread over')
+    parser_database.add_argument('--layout', type=str, default='normalized', choices=LAYOUTS, help='Database layout')
+    parser_database.add_argument('--directory', type=str, default='', help='Keep the database in this directory instead of a temporary one')
+    parser_database.set_defaults(submit=benchDatabase)
+
+    parser_startup = subparsers.add_parser('startup', help='Start up time of the command line tools and imports')
+    parser_startup.add_argument('--repeat', type=int, default=5, help='Number of runs of each command, the median is reported')
+    parser_startup.set_defaults(submit=benchStartup)
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    print json.dumps(args.submit(args), indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+
+from shardedLogMonitorAPI import getEra, openLogMonitor
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+# arrow and pandas modules
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+    import pandas
+    arrowLoaded = True
+except ImportError:
+    arrowLoaded = False
+
+STRINGS = ['dataset', 'file_name', 'severity', 'log_key', 'module']
+COLUMNS = STRINGS + ['count']
+
+def checkArrow():
+    if not arrowLoaded:
+        raise ImportError('The columnar engine needs pyarrow and pandas.\npip install pyarrow pandas')
+
+def makeTable(rows):
+    '''Arrow table of (dataset, file_name, severity, log_key, module, count) rows, string columns are dictionary encoded'''
+    columns = zip(*rows)
+    arrays = [pyarrow.array(list(col),type=pyarrow.string()).dictionary_encode() for col in columns[:len(STRINGS)]]
+    arrays += [pyarrow.array(list(columns[-1]),type=pyarrow.int64())]
+    arrays += [pyarrow.array([getEra(ds) for ds in columns[0]],type=pyarrow.string())]
+    return pyarrow.Table.from_arrays(arrays,names=COLUMNS+['era'])
+
+def export(lmclient,path,batchSize=1000000,**kwargs):
+    '''
+    Write the processed log counts as a Parquet dataset partitioned by era.
+    Accepts the conditions of LogMonitorAPI.summarize, returns the number of rows written.
+    Nothing is written, not even the directory, if no rows match.
+    '''
+    checkArrow()
+    nrows = 0
+    for rows in lmclient.iterProcessedRows(batchSize=batchSize,**kwargs):
+        parquet.write_to_dataset(makeTable(rows),path,partition_cols=['era'],use_dictionary=True,compression='snappy')
+        nrows += len(rows)
+        logging.info('{0} rows written to {1}'.format(nrows,path))
+    if not nrows:
+        logging.warning('Nothing to export, no processed rows match the selection')
+        return 0
+    with open(os.path.join(path,'_export.json'),'w') as f:
+        json.dump({'generation':lmclient.getGeneration(),'rows':nrows},f)
+    return nrows
+
+def makePattern(val):
+    '''Regular expression for a value with unix-like '*' wildcards, the other characters are literal like in LogMonitorAPI'''
+    return re.compile('^{0}$'.format('.*'.join([re.escape(part) for part in val.split('*')])))
+
+def eraFilter(dataset):
+    '''Partition filter for a dataset pattern whose era has no wildcard'''
+    parts = dataset.split('/')
+    if len(parts)<3 or '-' not in parts[2]: return None
+    era = parts[2].split('-')[0]
+    if not era or '*' in era: return None
+    return [('era','=',era)]
+
+def selectRows(frame,column,val):
+    '''Boolean mask of the rows matching val, the patterns are only evaluated on the distinct values of the column'''
+    if isinstance(val,(list,tuple,set)):
+        return frame[column].isin(list(val))
+    if '*' not in val:
+        return frame[column]==val
+    pattern = makePattern(val)
+    values = frame[column].cat.categories
+    return frame[column].isin([v for v in values if pattern.match(v)])
+
+def summarize(path,file_names=None,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+    '''
+    Same as LogMonitorAPI.summarize over an exported Parquet dataset.
+    Only the needed columns and era partitions are read, memory mapped with the string columns as categoricals.
+    '''
+    checkArrow()
+    groups = ['severity', 'log_key', 'module'] if merge_datasets else ['dataset', 'severity', 'log_key', 'module']
+    columns = groups + ['count']
+    conditions = dict([(key,val) for key,val in kwargs.iteritems() if isinstance(val,(basestring,list,tuple,set))])
+    needed = sorted(set(groups+conditions.keys()+(['file_name'] if file_names is not None else [])+['count']))
+    filters = eraFilter(conditions['dataset']) if isinstance(conditions.get('dataset'),basestring) else None
+    table = parquet.read_table(path,columns=needed,memory_map=True,filters=filters,read_dictionary=[c for c in needed if c in STRINGS])
+    frame = table.to_pandas()
+
+    mask = None
+    for column,val in sorted(conditions.iteritems()):
+        if column not in STRINGS: continue
+        if isinstance(val,basestring) and val.strip('*')=='': continue
+        selected = selectRows(frame,column,val)
+        mask = selected if mask is None else mask & selected
+    if file_names is not None:
+        selected = frame['file_name'].isin(list(file_names))
+        mask = selected if mask is None else mask & selected
+    if mask is not None: frame = frame[mask]
+
+    result = frame.groupby(groups,observed=True,sort=False)['count'].sum().reset_index()
+    if order_by:
+        if order_by not in columns: raise ValueError('Cannot order by {0}, valid columns are {1}'.format(order_by,columns))
+        others = [c for c in columns if c!=order_by]
+        result = result.sort_values([order_by]+others,ascending=[not descending]+[True]*len(others))
+    if limit is not None or offset:
+        result = result.iloc[offset:None if limit is None else offset+limit]
+    return [dict([(c,row[c] if c!='count' else int(row[c])) for c in columns]) for row in result[columns].to_dict('records')]
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Export the log counts to a columnar Parquet dataset')
+
+    parser.add_argument('--database', type=str, default='logMonitor.sqlite', help='Database file or directory of shards to export')
+    parser.add_argument('--output', type=str, default='logMonitor.parquet', help='Directory of the Parquet dataset, partitioned by era')
+    parser.add_argument('--dataset', type=str, default='/*/*/*', help='Datasets to export')
+    parser.add_argument('--batch-size', type=int, default=1000000, help='Number of rows per written batch')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    if os.path.exists(args.output):
+        logging.error('{0} already exists'.format(args.output))
+        return 1
+    lmclient = openLogMonitor(args.database,readonly=True)
+    export(lmclient,args.output,batchSize=args.batch_size,dataset=args.dataset)
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
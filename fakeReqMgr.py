@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+class FakeReqMgrHandler(BaseHTTPRequestHandler):
+    '''Answers name= and outputdataset= lookups like the ReqMgr request endpoint, after the configured delay'''
+
+    def do_GET(self):
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        self.server.begin(params)
+        try:
+            self.respond(params)
+        finally:
+            self.server.end()
+
+    def respond(self,params):
+        time.sleep(self.server.delay)
+        result = []
+        for reqname,request in sorted(self.server.requests.iteritems()):
+            if params.get('name')==reqname or params.get('outputdataset') in request.get('OutputDatasets',[]):
+                result += [{reqname:request}]
+        body = json.dumps({'result':result})
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        logging.debug(format%args)
+
+class FakeReqMgr(ThreadingMixIn,HTTPServer):
+    '''
+    Local stand-in for ReqMgr serving a dictionary of requests, requests maps a request name to its description.
+    Every lookup is recorded in lookups, active and maxActive count the concurrent lookups.
+    '''
+    daemon_threads = True
+
+    def __init__(self,requests,port=0,delay=0.):
+        HTTPServer.__init__(self,('localhost',port),FakeReqMgrHandler)
+        self.requests = requests
+        self.delay = delay
+        self.lookups = []
+        self.active = 0
+        self.maxActive = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://localhost:{0}/reqmgr2/data/request'.format(self.server_address[1])
+
+    def begin(self,params):
+        with self.lock:
+            self.lookups += [params]
+            self.active += 1
+            self.maxActive = max(self.maxActive,self.active)
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+
+    def start(self):
+        '''Serve in a background thread, returns the url of the request endpoint'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Fake ReqMgr server for testing logMonitor.py relval without cmsweb')
+
+    parser.add_argument('--requests', type=str, required=True, help='JSON file mapping request names to their descriptions')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--delay', type=float, default=0., help='Seconds to wait before answering, to mimic a remote server')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    with open(args.requests) as f:
+        requests = json.load(f)
+    server = FakeReqMgr(requests,args.port,args.delay)
+    logging.info('Serving {0} requests at {1}'.format(len(requests),server.url))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -7,121 +7,228 @@ import logging
 import argparse
 import itertools
 import fnmatch
-import subprocess
 import datetime
 import tarfile
-from LogMonitorAPI import LogMonitorAPI
+import threading
+from shardedLogMonitorAPI import getDatabase, openLogMonitor
+from responseCache import ResponseCache, CachedClient
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-# DBS modules
-try:
-    from dbs.apis.dbsClient import DbsApi
-    dbsLoaded = True
-except:
-    dbsLoaded = False
+# DBS modules, imported on first use
+dbsLoaded = None
 
-def process(command):
-    return subprocess.Popen(command,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT).communicate()[0]
+def loadDBS():
+    '''Import the DBS client, returns whether it is available'''
+    global DbsApi, dbsLoaded
+    if dbsLoaded is None:
+        try:
+            from dbs.apis.dbsClient import DbsApi
+            dbsLoaded = True
+        except ImportError:
+            dbsLoaded = False
+    return dbsLoaded
 
-def getDBSClient():
+def getResponseCache(refresh=False):
+    sqlfile = 'responseCache.sqlite'
+    return ResponseCache(sqlfile,refresh=refresh)
 
-    if not dbsLoaded:
+def getDBSClient(cache=None):
+
+    if not loadDBS():
         logging.error('You must source a crab environment to use DBS API.\nsource /cvmfs/cms.cern.ch/crab3/crab.sh')
         return False
 
     url = 'https://cmsweb.cern.ch/dbs/prod/global/DBSReader'
     dbsclient = DbsApi(url)
+    if cache: dbsclient = CachedClient(dbsclient,cache,'dbs')
 
     return dbsclient
 
-def getLogMonitorClient():
-    sqlfile = 'logMonitor.sqlite'
-    lmclient = LogMonitorAPI(sqlfile)
-    return lmclient
+# reports only read, so clients are shared by all requests of a server
+sharedClients = {}
+sharedLock = threading.Lock()
+threadClients = threading.local()
 
-def generateReport(**kwargs):
+def getLogMonitorClient(explain=False):
+    '''Shared read-only client, each thread reads through its own connection'''
+    sqlfile = getDatabase()
+    key = (os.path.abspath(sqlfile),explain)
+    with sharedLock:
+        if key not in sharedClients:
+            sharedClients[key] = openLogMonitor(sqlfile,explain=explain,readonly=True)
+    return sharedClients[key]
+
+def resetLogMonitorClients():
+    '''Close the shared clients, the next request opens the database again'''
+    with sharedLock:
+        for client in sharedClients.values():
+            client.close()
+        sharedClients.clear()
+
+def getSharedDBSClient(refresh=False):
+    '''DBS client and response cache of the current thread, reused across requests'''
+    if not hasattr(threadClients,'dbs'):
+        threadClients.cache = getResponseCache()
+        threadClients.dbs = getDBSClient(threadClients.cache)
+    threadClients.cache.refresh = refresh
+    return threadClients.dbs
+
+def generateRows(merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+    '''Summed counts as a list of rows, merging datasets, ordering and limits are applied in the database'''
     # remove arguments supported by log monitor, the rest are passed to dbs api
     dataset = kwargs.pop('dataset','/*/*/*')
     severity = kwargs.pop('severity','*')
     module = kwargs.pop('module','*')
     log_key = kwargs.pop('log_key','*')
+    explain = kwargs.pop('explain',False)
+    refresh = kwargs.pop('refresh',False)
+    engine = kwargs.pop('engine','sqlite')
+    columnar_path = kwargs.pop('columnar_path','logMonitor.parquet')
+    # unset DBS keys, like the empty --run_num default, do not select files
+    kwargs = dict([(key,val) for key,val in kwargs.iteritems() if val not in ('',None,[])])
 
     # setup clients
-    dbsclient = getDBSClient()
-    lmclient = getLogMonitorClient()
+    dbsclient = getSharedDBSClient(refresh=refresh)
+    lmclient = getLogMonitorClient(explain=explain)
 
-    # get processed files matching dataset
-    files = lmclient.listProcessedFiles(dataset=dataset)
+    # push the DBS file selection down to the database as a list of allowed files
+    file_names = None
+    if kwargs and loadDBS():
+        file_names = set()
+        for ds in lmclient.listDatasets(dataset=dataset):
+            file_names.update([f['logical_file_name'] for f in dbsclient.listFiles(dataset=ds['dataset'],**kwargs)])
 
-    datasets = set([f['dataset'] for f in files])
-    
-    # iterate through processed datasets to create summary object
+    # aggregate all matching files in one query, read the dataset rollups if there is no file selection
+    options = {
+        'merge_datasets' : merge_datasets,
+        'order_by' : order_by,
+        'descending' : descending,
+        'limit' : limit,
+        'offset' : offset,
+    }
+    if engine=='columnar':
+        # vectorized group-by over the exported Parquet dataset
+        import columnar
+        return columnar.summarize(columnar_path,file_names=file_names,dataset=dataset,severity=severity,module=module,log_key=log_key,**options)
+    if file_names is None:
+        return lmclient.summarizeDatasets(dataset=dataset,severity=severity,module=module,log_key=log_key,**options)
+    return lmclient.summarize(file_names=file_names,dataset=dataset,severity=severity,module=module,log_key=log_key,**options)
+
+def generateSummary(**kwargs):
+    '''Summary of the counts as nested dictionaries dataset -> severity -> log_key -> module -> count'''
     summary = {}
-    for dataset in sorted(datasets):
-        dfiles = [f['file_name'] for f in files if f['dataset']==dataset]
-        dbsfiles = dfiles
-        if kwargs and dbsLoaded: dbsfiles = [f['logical_file_name'] for f in dbsclient.listFiles(dataset=dataset,**kwargs)]
-        allResults = []
-        for f in dfiles:
-            if f not in dbsfiles: continue
-            allResults += lmclient.listModules(file_name=f,severity=severity,module=module,log_key=log_key)
-        for result in allResults:
-            if dataset not in summary: summary[dataset] = {}
-            sev = result['severity']
-            lk = result['log_key']
-            mod = result['module']
-            count = result['count']
-            if sev not in summary[dataset]: summary[dataset][sev] = {}
-            if lk not in summary[dataset][sev]: summary[dataset][sev][lk] = {}
-            if mod not in summary[dataset][sev][lk]: summary[dataset][sev][lk][mod] = 0
-            summary[dataset][sev][lk][mod] += count
-    return json.dumps(summary, indent=4, sort_keys=True)
+    for result in generateRows(**kwargs):
+        ds = result['dataset']
+        sev = result['severity']
+        lk = result['log_key']
+        mod = result['module']
+        if ds not in summary: summary[ds] = {}
+        if sev not in summary[ds]: summary[ds][sev] = {}
+        if lk not in summary[ds][sev]: summary[ds][sev][lk] = {}
+        summary[ds][sev][lk][mod] = result['count']
+    return summary
 
-def getReport(**kwargs):
-    allowed = [
-        'dataset', 
-        'severity',
-        'module',
-        'log_key',
-        'parent_dataset', 
-        'release_version', 
-        'pset_hash', 
-        'app_name', 
-        'output_module_label', 
-        'global_tag', 
-        'processing_version', 
-        'acquisition_era_name', 
-        'run_num', 
-        'physics_group_name', 
-        'logical_file_name', 
-        'primary_ds_name', 
-        'primary_ds_type', 
-        'processed_ds_name', 
-        'data_tier_name', 
-        'dataset_access_type', 
-        'prep_id', 
-        'create_by', 
-        'last_modified_by', 
-        'min_cdate', 
-        'max_cdate', 
-        'min_ldate', 
-        'max_ldate', 
-        'cdate', 
-        'ldate', 
-        'detail', 
-        'dataset_id',
-    ]
-    valid = True
+def generateReport(**kwargs):
+    return json.dumps(generateSummary(**kwargs), indent=4, sort_keys=True)
+
+allowedKeys = [
+    'dataset', 
+    'severity',
+    'module',
+    'log_key',
+    'parent_dataset', 
+    'release_version', 
+    'pset_hash', 
+    'app_name', 
+    'output_module_label', 
+    'global_tag', 
+    'processing_version', 
+    'acquisition_era_name', 
+    'run_num', 
+    'physics_group_name', 
+    'logical_file_name', 
+    'primary_ds_name', 
+    'primary_ds_type', 
+    'processed_ds_name', 
+    'data_tier_name', 
+    'dataset_access_type', 
+    'prep_id', 
+    'create_by', 
+    'last_modified_by', 
+    'min_cdate', 
+    'max_cdate', 
+    'min_ldate', 
+    'max_ldate', 
+    'cdate', 
+    'ldate', 
+    'detail', 
+    'dataset_id',
+]
+
+# options of the command line only, they are not valid keys and the web server refuses them
+cliOptions = ['explain', 'refresh', 'engine', 'columnar_path']
+
+def popOptions(kwargs):
+    '''Remove the command line options from kwargs and return them'''
+    return dict([(key,kwargs.pop(key)) for key in cliOptions if key in kwargs])
+
+def validate(**kwargs):
+    '''Returns an error message for unknown keys, empty if all keys are valid'''
     response = ''
     for key,val in kwargs.iteritems():
-        if key not in allowed:
+        if key not in allowedKeys:
             response += 'Unknown parameter: {0}={1}\n'.format(key,val)
-            valid = False
-    if valid:
-        response = generateReport(**kwargs)
-    else:
-        response += 'Valid keys are: {0}'.format(allowed)
+    if response:
+        response += 'Valid keys are: {0}'.format(allowedKeys)
+    return response
+
+def getSummary(**kwargs):
+    '''Same as getReport but returns python objects, raises ValueError for unknown keys'''
+    options = popOptions(kwargs)
+    response = validate(**kwargs)
+    if response: raise ValueError(response)
+    return generateSummary(**dict(kwargs.items()+options.items()))
+
+def getReportRows(merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,top=None,**kwargs):
+    '''
+    Same as getReport as a list of rows, raises ValueError for unknown keys.
+    top=N returns the N largest counts.
+    '''
+    options = popOptions(kwargs)
+    response = validate(**kwargs)
+    if response: raise ValueError(response)
+    if top is not None:
+        order_by = 'count'
+        descending = True
+        limit = top
+    return generateRows(merge_datasets=merge_datasets,order_by=order_by,descending=descending,limit=limit,offset=offset,**dict(kwargs.items()+options.items()))
+
+compareKeys = ['severity', 'module', 'log_key']
+
+def getComparison(baseline,target,normalize='file',order_by='score',descending=True,limit=None,offset=0,top=None,**kwargs):
+    '''
+    Counts of the baseline and target dataset patterns per severity, log_key, module with their delta, ratio and score,
+    see LogMonitorAPI.compareDatasets. top=N returns the N most significant differences.
+    Raises ValueError for unknown keys, DBS keys are not supported.
+    '''
+    options = popOptions(kwargs)
+    response = validate(**kwargs)
+    if response: raise ValueError(response)
+    unsupported = [key for key in kwargs if key not in compareKeys]
+    if unsupported: raise ValueError('Cannot compare with {0}, valid keys are {1}'.format(unsupported,compareKeys))
+    if top is not None:
+        order_by = 'score'
+        descending = True
+        limit = top
+    lmclient = getLogMonitorClient(explain=options.get('explain',False))
+    return lmclient.compareDatasets(baseline,target,normalize=normalize,order_by=order_by,descending=descending,limit=limit,offset=offset,**kwargs)
+
+def getReport(**kwargs):
+    options = popOptions(kwargs)
+    response = validate(**kwargs)
+    if not response:
+        response = generateReport(**dict(kwargs.items()+options.items()))
     return response
 
 
@@ -133,6 +240,13 @@ def parse_command_line(argv):
     dataset_full = parser.add_argument('--module', type=str, nargs='?', default='*', help='Module names')
     dataset_full = parser.add_argument('--log_key', type=str, nargs='?', default='*', help='Log key')
     run = parser.add_argument('--run_num', type=str, nargs='*', default='', help='Runs to include in report')
+    parser.add_argument('--explain', action='store_true', help='Log the SQL query plan of each query')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached DBS responses')
+    parser.add_argument('--engine', type=str, default='sqlite', choices=['sqlite','columnar'], help='Answer from the database or from a Parquet export made by columnar.py')
+    parser.add_argument('--columnar-path', type=str, default='logMonitor.parquet', help='Parquet dataset read by the columnar engine')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BASELINE','TARGET'), help='Compare two dataset patterns instead of reporting --dataset')
+    parser.add_argument('--normalize', type=str, default='file', choices=['file','none'], help='Compare the counts per processed file or the raw counts')
+    parser.add_argument('--top', type=int, help='Number of most significant differences to compare')
 
     return parser.parse_args(argv)
 
@@ -142,7 +256,20 @@ def main(argv=None):
 
     args = parse_command_line(argv)
 
-    print getReport(**vars(args))
+    kwargs = vars(args)
+    compare = kwargs.pop('compare')
+    normalize = kwargs.pop('normalize')
+    top = kwargs.pop('top')
+    if compare:
+        try:
+            rows = getComparison(compare[0],compare[1],normalize=normalize,top=top,severity=args.severity,module=args.module,log_key=args.log_key,explain=args.explain)
+        except ValueError as e:
+            logging.error(e)
+            return 1
+        print json.dumps(rows, indent=4, sort_keys=True)
+        return
+
+    print getReport(**kwargs)
 
 if __name__ == "__main__":
     status = main()
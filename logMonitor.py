@@ -7,52 +7,97 @@ import argparse
 import json
 import itertools
 import fnmatch
-import subprocess
 import datetime
-import tarfile
+import tempfile
+import shutil
+import sqlite3
 import socket
-from LogMonitorAPI import LogMonitorAPI
-
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-
-ROOT.gSystem.Load("libFWCoreFWLite.so")
-ROOT.gSystem.Load("libDataFormatsFWLite.so")
-ROOT.FWLiteEnabler.enable()
-
-from DataFormats.FWLite import Handle, Events
+import signal
+import urllib
+import urllib2
+import threading
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import Counter
+from shardedLogMonitorAPI import getDatabase, openLogMonitor
+from logParser import aggregateErrorSummary, readLogCollect
+from responseCache import ResponseCache, CachedClient, FakeClient, WATCH_TTLS
+from storage import getStorageLister
+from metrics import Metrics, MeteredClient, summarize
 
 logging.basicConfig(level=logging.DEBUG, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-# DBS modules
-try:
-    from dbs.apis.dbsClient import DbsApi
-    from RestClient.RestApi import RestApi
-    from RestClient.AuthHandling.X509Auth import X509Auth
-    dbsLoaded = True
-except:
-    dbsLoaded = False
+# heavy backends are imported on first use, so relval mode and --help start without them
+fwliteLoaded = False
+dbsLoaded = None
+
+def loadFWLite():
+    '''Import ROOT and load FWLite, only needed to read LogErrorMonitor files'''
+    global ROOT, Handle, Events, fwliteLoaded
+    if fwliteLoaded: return
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+    ROOT.gSystem.Load("libFWCoreFWLite.so")
+    ROOT.gSystem.Load("libDataFormatsFWLite.so")
+    ROOT.FWLiteEnabler.enable()
+
+    from DataFormats.FWLite import Handle, Events
+    fwliteLoaded = True
+
+def loadDBS():
+    '''Import the DBS and RestClient modules, returns whether they are available'''
+    global DbsApi, RestApi, X509Auth, dbsLoaded
+    if dbsLoaded is None:
+        # DBS modules
+        try:
+            from dbs.apis.dbsClient import DbsApi
+            from RestClient.RestApi import RestApi
+            from RestClient.AuthHandling.X509Auth import X509Auth
+            dbsLoaded = True
+        except ImportError:
+            dbsLoaded = False
+    return dbsLoaded
 
-def process(command):
-    return subprocess.Popen(command,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT).communicate()[0]
+def getResponseCache(refresh=False,ttls=None):
+    sqlfile = 'responseCache.sqlite'
+    return ResponseCache(sqlfile,ttls=ttls,refresh=refresh)
 
-def getDBSClient():
+def getWatchCache(args):
+    '''Response cache of a watcher, new datasets and running requests are looked up again on every poll'''
+    return getResponseCache(refresh=args.refresh,ttls=WATCH_TTLS)
 
-    if not dbsLoaded:
+def getDBSClient(cache=None,metrics=None):
+
+    if not loadDBS():
         logging.error('You must source a crab environment to use DBS API.\nsource /cvmfs/cms.cern.ch/crab3/crab.sh')
 
     url = 'https://cmsweb.cern.ch/dbs/prod/global/DBSReader'
     dbsclient = DbsApi(url)
+    if metrics: dbsclient = MeteredClient(dbsclient,metrics,'dbs')
+    if cache: dbsclient = CachedClient(dbsclient,cache,'dbs')
 
     return dbsclient
 
 class ReqMgrApi(object):
+    '''ReqMgr client, plain http urls (a local fake ReqMgr) are read without authentication'''
 
     def __init__(self,url=''):
-        self.rest_api = RestApi(auth=X509Auth(ssl_cert=None, ssl_key=None, ssl_verifypeer=True, ca_info=None),proxy=None)
         self.url = url
+        self.local = threading.local()
+
+    @property
+    def rest_api(self):
+        '''pycurl handles cannot be shared, each thread gets its own'''
+        if not hasattr(self.local,'rest_api'):
+            self.local.rest_api = RestApi(auth=X509Auth(ssl_cert=None, ssl_key=None, ssl_verifypeer=True, ca_info=None),proxy=None)
+        return self.local.rest_api
 
     def get(self,**params):
+        if self.url.startswith('http://'):
+            response = urllib2.urlopen('{0}?{1}'.format(self.url,urllib.urlencode(params)))
+            return json.loads(response.read())['result']
         content = 'application/json'
         UserID = os.environ['USER']+'@'+socket.gethostname()
         userAgent = ''
@@ -64,52 +109,214 @@ class ReqMgrApi(object):
         response = self.rest_api.get(self.url,'',params,{},request_headers)
         return json.loads(response.body)['result']
 
-def getReqMgrClient():
-    if not dbsLoaded:
+def getReqMgrClient(cache=None,metrics=None,url='https://cmsweb.cern.ch/reqmgr2/data/request'):
+    if not url.startswith('http://') and not loadDBS():
         logging.error('You must source a crab environment to use ReqMgr API.\nsource /cvmfs/cms.cern.ch/crab3/crab.sh')
 
-    reqmgr = 'https://cmsweb.cern.ch/reqmgr2/data/request'
-    reqmgrClient = ReqMgrApi(reqmgr)
+    reqmgrClient = ReqMgrApi(url)
+    if metrics: reqmgrClient = MeteredClient(reqmgrClient,metrics,'reqmgr')
+    if cache: reqmgrClient = CachedClient(reqmgrClient,cache,'reqmgr')
     return reqmgrClient
 
 def getLogMonitorClient():
-    sqlfile = 'logMonitor.sqlite'
-    lmclient = LogMonitorAPI(sqlfile)
+    sqlfile = getDatabase()
+    lmclient = openLogMonitor(sqlfile)
     return lmclient
 
-def processLogErrorFile(lfn):
-    allSeverities = {}
-    try:
+def getMetrics(args):
+    return Metrics(args.metrics,prometheus=args.prometheus)
+
+def processLogErrorFile(lfn,metrics=None):
+    '''
+    Read the error summaries of a LogErrorMonitor file, returns a Counter keyed by (severity, category, module).
+    The open and read stages are recorded in metrics.
+    '''
+    if metrics is None: metrics = Metrics()
+    loadFWLite()
+    results = Counter()
+    bytesRead = ROOT.TFile.GetFileBytesRead()
+    with metrics.timer('open'):
         events = Events(lfn)
-        errorSummaryHandle = Handle('std::vector<edm::ErrorSummaryEntry>')
-        errorSummaryLabel = ('logErrorHarvester')
-        for i,event in enumerate(events):
+    errorSummaryHandle = Handle('std::vector<edm::ErrorSummaryEntry>')
+    errorSummaryLabel = ('logErrorHarvester')
+    product = errorSummaryHandle.product
+    with metrics.timer('read') as counts:
+        for event in events:
             event.getByLabel(errorSummaryLabel,errorSummaryHandle)
-            errorSummary = errorSummaryHandle.product()
-            for es in errorSummary:
-                severity = es.severity.getName()
-                category = es.category
-                module = es.module
-                count = es.count
-                if severity not in allSeverities:
-                    allSeverities[severity] = {}
-                if category not in allSeverities[severity]:
-                    allSeverities[severity][category] = {
-                        'count' : 0,
-                        'modules' : [],
-                    }
-                allSeverities[severity][category]['count'] += count
-                allSeverities[severity][category]['modules'] += [module]
-    except Exception as e:
-        print e
-
-    return allSeverities
-
-def dataMonitor(args):
-    '''Monitor script for data LogError'''
-    dbsclient = getDBSClient()
-    lmclient = getLogMonitorClient()
+            aggregateErrorSummary(results,product())
+        counts['bytes'] = ROOT.TFile.GetFileBytesRead()-bytesRead
+    return results
 
+def dataWorker(task,metrics):
+    '''Process a LogErrorMonitor file, returns (severity, log_key, module, count) tuples'''
+    results = processLogErrorFile(task['path'],metrics)
+    return [(severity,category,mod,count) for (severity,category,mod),count in results.iteritems()]
+
+def relvalWorker(task,metrics):
+    '''Process a LogCollect tarball, returns (severity, log_key, module, count) tuples'''
+    results = readLogCollect(task['path'],metrics)
+    return [(severity,log_key,mod,count) for (severity,log_key,mod),count in results.iteritems()]
+
+def runTask(task):
+    '''Run a task in a worker, failures are returned instead of raised so they can be retried'''
+    metrics = Metrics()
+    result = {
+        'task' : task,
+        'counts' : [],
+        'error' : '',
+        'metrics' : metrics.samples,
+    }
+    try:
+        result['counts'] = task['worker'](task,metrics)
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__,e)
+    return result
+
+def ingestResult(lmclient,result):
+    '''Write a worker result, the module rows and processed markers are committed together'''
+    task = result['task']
+    rows = [{'file_name':task['file_name'],'module':mod,'severity':severity,'log_key':log_key,'count':count} for severity,log_key,mod,count in result['counts']]
+    with lmclient.transaction():
+        lmclient.insertModules(rows)
+        for ds in task['datasets']:
+            lmclient.insertProcessedFile(file_name=task['file_name'],dataset=ds)
+        lmclient.finishWork(task['file_name'])
+
+def recordFile(metrics,result,attempt):
+    '''Log the stages of a file and add their per-file totals to the run histograms'''
+    stages = summarize(result['metrics'])
+    for stage,values in stages.iteritems():
+        metrics.record(stage,values['seconds'],**dict([(key,values[key]) for key in ['bytes','lines','rows'] if key in values]))
+    metrics.log(type='file',file_name=result['task']['file_name'],attempt=attempt+1,error=result['error'],stages=stages)
+
+def ignoreInterrupt():
+    '''Workers leave SIGINT to the main process, which decides when to stop them'''
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+def submitTasks(lmclient,tasks,pool=None,window=1):
+    '''
+    Yield the results of the tasks as they finish, each task is marked running in the work journal when it is submitted.
+    tasks are taken, journaled and submitted by the calling thread, at most window of them are in flight on the pool.
+    '''
+    if pool is None:
+        for task in tasks:
+            lmclient.startWork(task['file_name'],task['worker'].__name__,task['path'],task['datasets'])
+            yield runTask(task)
+        return
+    results = Queue.Queue()
+    tasks = iter(tasks)
+    inflight = 0
+    exhausted = False
+    while True:
+        while not exhausted and inflight<window:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            lmclient.startWork(task['file_name'],task['worker'].__name__,task['path'],task['datasets'])
+            pool.apply_async(runTask,(task,),callback=results.put)
+            inflight += 1
+        if not inflight: return
+        yield results.get()
+        inflight -= 1
+
+def processTasks(args,lmclient,tasks,metrics=None,stop=None,ingested=None):
+    '''
+    Run tasks on a pool of args.jobs worker processes.
+    Only this process touches the database, it consumes tasks and journals and ingests the files.
+    Failed tasks are retried up to args.retries times and are never marked processed.
+    tasks can be a generator, the first attempt starts while it is still producing tasks,
+    at most twice args.jobs files are submitted ahead of the results.
+    The stages of each file are recorded in metrics.
+    Once the stop event is set the remaining files are abandoned after the current one is ingested.
+    The state, attempts and timings of each file are kept in the work journal of the database.
+    The names of the ingested files are added to the set ingested.
+    Returns the tasks that still failed.
+    '''
+    if metrics is None: metrics = Metrics()
+    if isinstance(tasks,list):
+        lmclient.queueWork([dict(task,worker=task['worker'].__name__) for task in tasks])
+    pool = multiprocessing.Pool(args.jobs,initializer=ignoreInterrupt) if args.jobs>1 else None
+    stopped = False
+    done = False
+    try:
+        for attempt in range(args.retries+1):
+            if not tasks or stopped: break
+            failed = []
+            ntasks = len(tasks) if isinstance(tasks,list) else '?'
+            for t, result in enumerate(submitTasks(lmclient,tasks,pool,2*args.jobs)):
+                task = result['task']
+                if result['error']:
+                    logging.warning('{0}/{1} {2} failed (attempt {3}): {4}'.format(t+1,ntasks,task['file_name'],attempt+1,result['error']))
+                    lmclient.finishWork(task['file_name'],result['error'])
+                    failed += [task]
+                else:
+                    logging.info('{0}/{1} {2}'.format(t+1,ntasks,task['file_name']))
+                    start = time.time()
+                    ingestResult(lmclient,result)
+                    if ingested is not None: ingested.add(task['file_name'])
+                    result['metrics'] += [('insert',time.time()-start,{'rows':len(result['counts'])})]
+                recordFile(metrics,result,attempt)
+                if stop is not None and stop.is_set():
+                    logging.info('Stopping, unfinished files are left for the next run')
+                    stopped = True
+                    break
+            tasks = failed
+        if not stopped:
+            for task in tasks:
+                logging.error('{0} failed {1} times, not marked processed'.format(task['file_name'],args.retries+1))
+        done = True
+    finally:
+        if pool:
+            if done and not stopped:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    return tasks
+
+WORKERS = dict([(worker.__name__,worker) for worker in [dataWorker,relvalWorker]])
+
+def findJournalTasks(args,lmclient,worker):
+    '''
+    Tasks of the failed and unfinished (pending or running) files of the work journal done by worker,
+    restricted to args.request or the datasets matching args.dataset.
+    '''
+    tasks = []
+    for work in lmclient.listWork(state=['pending','running','failed'],worker=worker.__name__):
+        if getattr(args,'request',''):
+            if '/{0}/'.format(args.request) not in work['file_name']: continue
+        elif not any([fnmatch.fnmatch(ds,args.dataset) for ds in work['datasets']]):
+            continue
+        logging.info('Resuming {0}, {1} after {2} attempts {3}'.format(work['file_name'],work['state'],work['attempts'],work['error']))
+        tasks += [{
+            'worker' : WORKERS[work['worker']],
+            'file_name' : work['file_name'],
+            'path' : work['path'],
+            'datasets' : work['datasets'],
+        }]
+    return tasks
+
+def isUnchanged(previous,dsname,mark):
+    '''Check a dataset against the high-water mark recorded by the previous run'''
+    if dsname not in previous: return False
+    return all([previous[dsname][key]==val for key,val in mark.iteritems()])
+
+def recordMarks(lmclient,marks,failed):
+    '''Store the high-water marks of the datasets without failed files'''
+    failedDatasets = set([ds for task in failed for ds in task['datasets']])
+    with lmclient.transaction():
+        for ds,mark in marks.iteritems():
+            if ds in failedDatasets: continue
+            lmclient.insertDatasetMark(ds,**mark)
+
+def findDataFiles(args,dbsclient,lmclient,marks,processed=None):
+    '''
+    Find the unprocessed files of the datasets matching args.dataset, returns a list of tasks.
+    The high-water marks of the changed datasets are added to marks.
+    processed is the set of processed file names, read from the database per changed dataset if not given.
+    '''
     #kwargs = {}
     #if args.primaryDataset: kwargs['primary_ds_name'] = args.primaryDataset
     #if args.acquisitionEra: kwargs['acquisition_era_name'] = args.acquisitionEra
@@ -117,88 +324,85 @@ def dataMonitor(args):
     ##kwargs['detail'] = True
     #datasets = dbsclient.listDatasets(**kwargs)
 
-    datasets = dbsclient.listDatasets(dataset=args.dataset)
+    datasets = dbsclient.listDatasets(dataset=args.dataset,detail=True)
 
+    # high-water marks of the previous runs
+    previous = dict([(m['dataset'],m) for m in lmclient.listDatasetMarks(dataset=args.dataset)])
+
+    tasks = []
     for dataset in datasets:
         dsname = dataset['dataset']
+        summary = dbsclient.listFileSummaries(dataset=dsname)
+        mark = {
+            'nfiles' : (summary[0]['num_file'] if summary else 0) or 0,
+            'last_modified' : dataset.get('last_modification_date',0) or 0,
+        }
+        if isUnchanged(previous,dsname,mark):
+            logging.info('{0} unchanged since last run'.format(dsname))
+            continue
+        marks[dsname] = mark
+        # processed files are only read for the datasets that changed
+        pfnames = lmclient.getProcessedFileNames(dataset=dsname) if processed is None else processed
         files = dbsclient.listFiles(dataset=dsname)
         logging.info('{0} {1}'.format(dsname, len(files)))
         fnames = [f['logical_file_name'] for f in files]
-        prevfiles = lmclient.listProcessedFiles(dataset=dsname)
-        pfnames = [p['file_name'] for p in prevfiles]
         nfiles = len(fnames)
         for f,fname in enumerate(fnames):
             if fname in pfnames:
                 logging.info('{0}/{1} {2} already processed'.format(f+1, nfiles, fname))
                 continue
-            logging.info('{0}/{1} {2}'.format(f+1, nfiles, fname))
-            lfn = 'root://{0}/{1}'.format(args.redirector,fname)
-            allSeverities = processLogErrorFile(lfn)
-            for severity in allSeverities:
-                for error in allSeverities[severity]:
-                    if error=='MemoryCheck': continue # manually skip MemoryCheck module
-                    for mod in set(allSeverities[severity][error]['modules']):
-                        lmclient.insertModule(file_name=fname,module=mod,severity=severity,log_key=error,count=allSeverities[severity][error]['modules'].count(mod))
-            lmclient.insertProcessedFile(file_name=fname,dataset=dsname)
-
-
-def parseFrameworkJobReport(content):
-    return
-    print content
-    
-def parseLogFile(results,content):
-    for line in content:
-        if 'MemoryCheck:' in line: continue
-        if 'MSG-e' in line: # error
-            severity = 'Error'
-        elif 'MSG-w' in line: # warning
-            severity = 'Warning'
-        else:
-            continue
-        components = line.strip().split()
-        log_key = components[1].strip(':') if len(components)>1 else 'unknown'
-        module = components[2] if len(components)>2 else 'unknown'
-        if severity not in results:
-            results[severity] = {}
-        if log_key not in results[severity]:
-            results[severity][log_key] = {
-                'modules': [],
-            }
-        results[severity][log_key]['modules'] += [module]
-    return results
-    
-def processRequest(args,request):
+            tasks += [{
+                'worker' : dataWorker,
+                'file_name' : fname,
+                'path' : 'root://{0}/{1}'.format(args.redirector,fname),
+                'datasets' : [dsname],
+            }]
+    return tasks
+
+def dataMonitor(args):
+    '''Monitor script for data LogError'''
+    metrics = getMetrics(args)
+    dbsclient = getDBSClient(metrics=metrics)
     lmclient = getLogMonitorClient()
+    # loaded once before the workers are forked
+    loadFWLite()
+
+    marks = {}
+    if args.resume:
+        tasks = findJournalTasks(args,lmclient,dataWorker)
+    else:
+        tasks = findDataFiles(args,dbsclient,lmclient,marks)
+    failed = processTasks(args,lmclient,tasks,metrics)
+    recordMarks(lmclient,marks,failed)
+    metrics.close()
+
+
+def findRequestFiles(args,lmclient,lister,request,marks,processed=None):
+    '''
+    Find the unprocessed LogCollect files of a request, returns a list of tasks.
+    The high-water marks of the output datasets are added to marks.
+    processed is the set of processed file names, read from the database if not given.
+    '''
 
-    unmergedLogDir = '/store/unmerged/data/logs/prod/{year}/{month:02d}/{day}'
     logDir = '/store/logs/prod/{year}/{month:02d}/WMAgent'
-    eos = '/afs/cern.ch/project/eos/installation/0.3.84-aquamarine/bin/eos.select'
     reqname = request.keys()[0]
 
-    # guess the request directory
+    # guess the request directory, falling back to one month later
     reqdate = request[reqname]['RequestDate']
-    year = reqdate[0]
-    month = reqdate[1]
+    year = int(reqdate[0])
+    month = int(reqdate[1])
     day = reqdate[2]
-    baseDir = logDir
-    fullDir = baseDir.format(year=year,month=month,day=day)
-
-    # get output logs
-    ls_command = '{0} ls {1}/{2}'.format(eos,fullDir,reqname)
-    lcfiles = process(ls_command)
-    lcfiles = [x.strip() for x in lcfiles.split() if fnmatch.fnmatch(x.strip(),'{0}-LogCollect*'.format(reqname))]
+    guesses = [(year,month), (year+1,1) if month==12 else (year,month+1)]
+
+    # get output logs, the month listings are shared by all requests in the run
+    lcfiles = []
+    for year, month in guesses:
+        fullDir = logDir.format(year=year,month=month,day=day)
+        if reqname not in lister.listdir(fullDir): continue
+        lcfiles = [x for x in lister.listdir('{0}/{1}'.format(fullDir,reqname)) if fnmatch.fnmatch(x,'{0}-LogCollect*'.format(reqname))]
+        if lcfiles: break
     nfiles = len(lcfiles)
 
-    # fall back to try one month later
-    if nfiles==0:
-        newmonth = int(month)+1
-        if newmonth>12: newmonth -= 12
-        fullDir = baseDir.format(year=year,month=newmonth,day=day)
-        ls_command = '{0} ls {1}/{2}'.format(eos,fullDir,reqname)
-        lcfiles = process(ls_command)
-        lcfiles = [x.strip() for x in lcfiles.split() if fnmatch.fnmatch(x.strip(),'{0}-LogCollect*'.format(reqname))]
-        nfiles = len(lcfiles)
-
     # associate output logCollect with datasetnames
     tasks = [v for k,v in request[reqname].iteritems() if k.startswith('Task') and isinstance(v,dict)]
     outputdatasets = {}
@@ -206,64 +410,278 @@ def processRequest(args,request):
         for task in tasks:
             if task['ProcessingString'] in ds: outputdatasets[ds] = task['TaskName']
 
-    # check for previously processed files
-    prevfiles = []
+    # skip requests without new LogCollect files since the last run
+    previous = dict([(m['dataset'],m) for m in lmclient.listDatasetMarks(dataset=outputdatasets.keys())])
+    if nfiles and all([isUnchanged(previous,ds,{'nfiles':nfiles}) for ds in outputdatasets]):
+        logging.info('{0} unchanged since last run'.format(reqname))
+        return []
     for ds in outputdatasets:
-        prevfiles += lmclient.listProcessedFiles(dataset=ds)
-    pfnames = set([p['file_name'] for p in prevfiles])
+        marks[ds] = {'nfiles':nfiles}
 
-    # process found files
+    # check for previously processed files
+    pfnames = lmclient.getProcessedFileNames(dataset=outputdatasets.keys()) if processed is None else processed
+
+    # create tasks for the found files
+    tasks = []
     logging.info('{0} {1}'.format(outputdatasets.keys()[0], nfiles))
     for l, lcfile in enumerate(lcfiles):
-        results = {}
         lfn = '{0}/{1}/{2}'.format(fullDir,reqname,lcfile)
-        xrdpath = 'root://{0}/{1}'.format(args.redirector,lfn)
         eospath = 'eos/cms/{0}'.format(lfn)
+        if args.storage=='local': eospath = os.path.join(args.storage_root,lfn.lstrip('/'))
         if lfn in pfnames:
             logging.info('{0}/{1} {2} already processed'.format(l+1,nfiles,lfn))
             continue
-        logging.info('{0}/{1} {2}'.format(l+1,nfiles,lfn))
-        with tarfile.open(eospath) as tf:
-            for member in tf.getmembers()[:1]:
-                tfg_f = tf.extractfile(member)
-                with tarfile.open(fileobj=tfg_f) as tfg:
-                    for mem in tfg.getmembers():
-                        filename, ftype = os.path.splitext(mem.name)
-                        if ftype not in ['.log','.xml']: continue
-                        if 'FrameworkJobReport' in filename:
-                            log_f = tfg.extractfile(mem)
-                            content = log_f.read()
-                            parseFrameworkJobReport(content)
-                        if 'stdout' in filename:
-                            log_f = tfg.extractfile(mem)
-                            content = log_f.readlines()
-                            results = parseLogFile(results,content)
-        for severity in results:
-            for log_key in results[severity]:
-                for mod in set(results[severity][log_key]['modules']):
-                    lmclient.insertModule(file_name=lfn,module=mod,severity=severity,log_key=log_key,count=results[severity][log_key]['modules'].count(mod))
-        for ds in outputdatasets:
-            if outputdatasets[ds] in lfn: lmclient.insertProcessedFile(file_name=lfn,dataset=ds)
+        tasks += [{
+            'worker' : relvalWorker,
+            'file_name' : lfn,
+            'path' : eospath,
+            'datasets' : [ds for ds in outputdatasets if outputdatasets[ds] in lfn],
+        }]
+    return tasks
+
+def getLister(args,metrics=None):
+    kwargs = {}
+    if args.storage=='local': kwargs['root'] = args.storage_root
+    if args.storage=='xrootd': kwargs['server'] = args.storage_server
+    lister = getStorageLister(args.storage,**kwargs)
+    # only the listings that reach the storage are timed
+    if metrics: lister.lister = MeteredClient(lister.lister,metrics,'listing')
+    return lister
+
+def resolveRequests(args,rmclient,dsnames):
+    '''
+    Look up the requests of the datasets in ReqMgr on args.lookups threads, yields each request once as soon as it is resolved.
+    Datasets that are outputs of an already resolved request are not looked up.
+    '''
+    covered = set()
+    lock = threading.Lock()
+
+    def lookup(dsname):
+        with lock:
+            if dsname in covered: return dsname, []
+        try:
+            return dsname, rmclient.get(outputdataset=dsname)
+        except Exception as e:
+            logging.error('ReqMgr lookup of {0} failed: {1}: {2}'.format(dsname,type(e).__name__,e))
+            return dsname, []
+
+    seen = set()
+    pool = ThreadPool(args.lookups)
+    try:
+        for dsname, res in pool.imap_unordered(lookup,dsnames):
+            if not res: continue
+            request = res[0]
+            reqname = request.keys()[0]
+            # several output datasets of the same request
+            if reqname in seen: continue
+            seen.add(reqname)
+            with lock:
+                covered.update(request[reqname].get('OutputDatasets',[]))
+            yield request
+    finally:
+        pool.close()
+        pool.join()
+
+def findRelvalFiles(args,dbsclient,rmclient,lmclient,lister,marks,processed=None):
+    '''
+    Yield the tasks of the unprocessed LogCollect files of the requests selected by args.request or args.dataset.
+    The files of resolved requests are yielded while the other lookups are running.
+    '''
+    if args.request:
+        requests = rmclient.get(name=args.request)
+    else:
+        datasets = dbsclient.listDatasets(dataset=args.dataset)
+        requests = resolveRequests(args,rmclient,[dataset['dataset'] for dataset in datasets])
+
+    for request in requests:
+        try:
+            found = findRequestFiles(args,lmclient,lister,request,marks,processed)
+        except Exception as e:
+            logging.error('Finding the files of {0} failed: {1}: {2}'.format(request.keys()[0],type(e).__name__,e))
+            continue
+        for task in found:
+            yield task
 
 def relvalMonitor(args):
     '''Monitor script for relval requests'''
-    dbsclient = getDBSClient()
-    rmclient = getReqMgrClient()
+    metrics = getMetrics(args)
+    cache = getResponseCache(refresh=args.refresh)
+    dbsclient = getDBSClient(cache,metrics)
+    rmclient = getReqMgrClient(cache,metrics,args.reqmgr_url)
+    lmclient = getLogMonitorClient()
+    lister = getLister(args,metrics)
 
-    if args.request:
-        res = rmclient.get(name=args.request)
-        for request in res:
-            processRequest(args,request)
+    # the files of all requests share one worker pool
+    marks = {}
+    if args.resume:
+        tasks = findJournalTasks(args,lmclient,relvalWorker)
     else:
-        # get datasets
-        datasets = dbsclient.listDatasets(dataset=args.dataset)
+        tasks = findRelvalFiles(args,dbsclient,rmclient,lmclient,lister,marks)
+    failed = processTasks(args,lmclient,tasks,metrics)
+    recordMarks(lmclient,marks,failed)
+    metrics.close()
+
+def watchPoll(args,stop,dbsclient,rmclient,lmclient,processed,metrics):
+    '''
+    Queue and process the new files once, returns True if all new files were processed.
+    Files are added to processed once they are ingested, so failed and unfinished ones are retried by the next poll.
+    '''
+    marks = {}
+    if args.mode=='relval':
+        # listings are only cached for one poll
+        tasks = findRelvalFiles(args,dbsclient,rmclient,lmclient,getLister(args,metrics),marks,processed)
+    else:
+        tasks = findDataFiles(args,dbsclient,lmclient,marks,processed)
 
-        for dataset in datasets:
-            # find request name from reqmgr
-            dsname = dataset['dataset']
-            res = rmclient.get(outputdataset=dsname)
-            request = res[0]
-            processRequest(args,request)
+    queued = []
+    full = [False]
+    def queue():
+        for task in tasks:
+            if stop.is_set(): return
+            if len(queued)>=args.queue_size:
+                full[0] = True
+                return
+            queued.append(task)
+            yield task
+
+    failed = processTasks(args,lmclient,queue(),metrics,stop,processed)
+    logging.info('Processed {0} new files, {1} failed'.format(len(queued)-len(failed),len(failed)))
+
+    # the marks are only valid once all files of the datasets are processed
+    if full[0] or stop.is_set(): return False
+    with lmclient.transaction():
+        recordMarks(lmclient,marks,failed)
+        lmclient.setMetadata('watch_checkpoint',int(time.time()))
+    return True
+
+def watchMonitor(args):
+    '''
+    Stay resident and process new files as they appear.
+    Clients, the database connection and the processed file names are kept between polls.
+    DBS and the log directories are polled every args.interval seconds, failed polls back off up to args.max_interval.
+    At most args.queue_size files are queued per poll, a full queue is followed by another poll right away.
+    SIGINT and SIGTERM stop after the files being ingested, the time of the last complete poll is checkpointed in the database.
+    '''
+    stop = threading.Event()
+    def shutdown(signum,frame):
+        logging.info('Received signal {0}, shutting down'.format(signum))
+        stop.set()
+    signal.signal(signal.SIGINT,shutdown)
+    signal.signal(signal.SIGTERM,shutdown)
+
+    metrics = getMetrics(args)
+    lmclient = getLogMonitorClient()
+    rmclient = None
+    if args.mode=='relval':
+        cache = getWatchCache(args)
+        dbsclient = getDBSClient(cache,metrics)
+        rmclient = getReqMgrClient(cache,metrics,args.reqmgr_url)
+        processed = lmclient.getProcessedFileNames()
+    else:
+        dbsclient = getDBSClient(metrics=metrics)
+        processed = lmclient.getProcessedFileNames(dataset=args.dataset)
+        loadFWLite()
+    logging.info('Watching with {0} processed files'.format(len(processed)))
+
+    # retry the files left over by a crashed run first
+    if args.resume:
+        tasks = findJournalTasks(args,lmclient,relvalWorker if args.mode=='relval' else dataWorker)
+        processTasks(args,lmclient,tasks,metrics,stop,processed)
+
+    # resume the schedule of the previous run
+    wait = lmclient.getMetadata('watch_checkpoint')+args.interval-time.time()
+    if wait>0:
+        logging.info('Last complete poll {0:.0f} s ago, next poll in {1:.0f} s'.format(args.interval-wait,wait))
+        stop.wait(wait)
+
+    interval = args.interval
+    while not stop.is_set():
+        try:
+            complete = watchPoll(args,stop,dbsclient,rmclient,lmclient,processed,metrics)
+            interval = args.interval
+        except Exception as e:
+            interval = min(2*interval,args.max_interval)
+            logging.error('Poll failed, next poll in {0} s: {1}: {2}'.format(interval,type(e).__name__,e))
+            complete = True
+        if not complete: continue
+        stop.wait(interval)
+    metrics.close()
+
+def watchTest(args):
+    '''
+    Offline test of watch relval with fake DBS and ReqMgr clients and LogCollect files on a local store.
+    A dataset is published between polls and an ingest fails once, both must be processed by the following polls.
+    '''
+    import benchmark
+    failures = []
+    def check(name,ok):
+        print name, 'OK' if ok else 'FAILED'
+        if not ok: failures.append(name)
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        root = os.path.join(tmpdir,'eos')
+        pattern = '/RelValTTbar/CMSSW_X_*/GEN-SIM-RECO'
+        requests = {}
+        published = []
+        def publish(n,nfiles):
+            reqname = 'user_RVCMSSW_X_TTbar_{0}'.format(n)
+            dataset = '/RelValTTbar/CMSSW_X_PS{0}-v1/GEN-SIM-RECO'.format(n)
+            requests[reqname] = {
+                'RequestDate' : [2026,10,18],
+                'RequestStatus' : 'running-open',
+                'OutputDatasets' : [dataset],
+                'Task1' : {'ProcessingString':'PS{0}'.format(n),'TaskName':'Task{0}'.format(n)},
+            }
+            reqdir = os.path.join(root,'store/logs/prod/2026/10/WMAgent',reqname)
+            os.makedirs(reqdir)
+            for f in range(nfiles):
+                benchmark.makeLogCollect(os.path.join(reqdir,'{0}-LogCollect-Task{1}-{2}.tar'.format(reqname,n,f)),2,2000,seed=10*n+f)
+            published.append(dataset)
+        def getRequests(name=None,outputdataset=None):
+            return [{reqname:request} for reqname,request in requests.iteritems() if name==reqname or outputdataset in request['OutputDatasets']]
+        dbs = FakeClient(listDatasets=lambda dataset: [{'dataset':ds} for ds in published if fnmatch.fnmatch(ds,dataset)])
+        reqmgr = FakeClient(get=getRequests)
+
+        watchArgs = parse_command_line(['watch','--interval','1','relval','--dataset',pattern,'--storage','local','--storage-root',root])
+        metrics = Metrics()
+        lmclient = getLogMonitorClient()
+        processed = set()
+        stop = threading.Event()
+        publish(1,1)
+        # a relval run caches the dataset search before the next dataset is published
+        CachedClient(dbs,getResponseCache(),'dbs').listDatasets(dataset=pattern)
+        cache = getWatchCache(watchArgs)
+        dbsclient = CachedClient(dbs,cache,'dbs')
+        rmclient = CachedClient(reqmgr,cache,'reqmgr')
+
+        watchPoll(watchArgs,stop,dbsclient,rmclient,lmclient,processed,metrics)
+        check('first poll',len(processed)==1)
+
+        # the first ingest of the new dataset fails as if the database were locked
+        publish(2,2)
+        insertProcessedFile = lmclient.insertProcessedFile
+        def lockedOnce(**kwargs):
+            lmclient.insertProcessedFile = insertProcessedFile
+            raise sqlite3.OperationalError('database is locked')
+        lmclient.insertProcessedFile = lockedOnce
+        try:
+            watchPoll(watchArgs,stop,dbsclient,rmclient,lmclient,processed,metrics)
+        except sqlite3.OperationalError as e:
+            logging.info('Poll failed: {0}'.format(e))
+        check('failed poll keeps unfinished files',len(processed)==1)
+
+        watchPoll(watchArgs,stop,dbsclient,rmclient,lmclient,processed,metrics)
+        check('published dataset processed',len(processed)==3)
+        check('all files in the database',lmclient.getProcessedFileNames()==processed)
+        check('dataset searched on every poll',len([call for call in dbs.calls if call[0]=='listDatasets'])==4)
+        lmclient.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    if failures: return 1
 
 # previous version
 #def relvalMonitor(args):
@@ -318,18 +736,7 @@ def relvalMonitor(args):
 #                        lmclient.insertModule(file_name=lfn,module=mod,severity=severity,log_key=log_key,count=results[severity][log_key]['modules'].count(mod))
 #            lmclient.insertProcessedFile(file_name=lfn,dataset=sample)
 
-def parse_command_line(argv):
-    parser = argparse.ArgumentParser(description='Log monitoring for RECO')
-
-    parser.add_argument('--redirector',type=str,nargs='?',default='cms-xrd-global.cern.ch', help='Redirector for xrootd')
-
-    subparsers = parser.add_subparsers(help='Log monitor mode')
-
-    ################################
-    ### data LogError monitoring ###
-    ################################
-    parser_data = subparsers.add_parser('data', help='Monitor data taking')
-
+def addDataArguments(parser_data):
     # dataset to process
     dataset_full = parser_data.add_argument('--dataset', required=True, type=str, nargs='?', default='/Dummy/*LogErrorMonitor*/USER', help='Full dataset name')
     #dataset_components = parser_data.add_argument_group(description='Dataset components')
@@ -337,13 +744,7 @@ def parse_command_line(argv):
     #dataset_components.add_argument('--acquisitionEra', type=str, nargs='?', default='Run2016*', help='Acquisition era for dataset')
     #dataset_components.add_argument('--dataTier', type=str, nargs='?', default='USER', help='Data tier for dataset')
 
-    parser_data.set_defaults(submit=dataMonitor)
-
-    #########################
-    ### relval monitoring ###
-    #########################
-    parser_relval = subparsers.add_parser('relval', help='Monitor relval workflows')
-
+def addRelvalArguments(parser_relval):
     now = datetime.datetime.now()
 
     relval_source = parser_relval.add_mutually_exclusive_group(required=True)
@@ -355,8 +756,62 @@ def parse_command_line(argv):
     #parser_relval.add_argument('--day', type=str, nargs='?', default=now.day, help='Day to process')
     #parser_relval.add_argument('--unmerged', action='store_true', help='Use unmerged from T0 (data only)')
 
+    parser_relval.add_argument('--storage', type=str, default='eos', choices=['eos','local','xrootd'], help='Backend used to list the log directories')
+    parser_relval.add_argument('--storage-root', type=str, default='/eos/cms', help='Mount point of the store for the local backend')
+    parser_relval.add_argument('--storage-server', type=str, default='eoscms.cern.ch', help='Server for the xrootd backend')
+
+    parser_relval.add_argument('--reqmgr-url', type=str, default='https://cmsweb.cern.ch/reqmgr2/data/request', help='ReqMgr request endpoint, http urls are read without authentication')
+    parser_relval.add_argument('--lookups', type=int, default=8, help='Number of concurrent ReqMgr lookups')
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Log monitoring for RECO')
+
+    parser.add_argument('--redirector',type=str,nargs='?',default='cms-xrd-global.cern.ch', help='Redirector for xrootd')
+    parser.add_argument('-j','--jobs',type=int,default=1, help='Number of worker processes reading files in parallel')
+    parser.add_argument('--retries',type=int,default=2, help='Number of times a failed file is retried')
+    parser.add_argument('--refresh',action='store_true', help='Ignore cached DBS and ReqMgr responses')
+    parser.add_argument('--metrics',type=str,default='', help='Append per-file and per-run stage timings to this JSON lines file')
+    parser.add_argument('--prometheus',type=str,default='', help='Write the run summary to this Prometheus textfile')
+    parser.add_argument('--resume',action='store_true', help='Only retry the failed and unfinished files of the work journal, without looking for new files')
+
+    subparsers = parser.add_subparsers(help='Log monitor mode')
+
+    ################################
+    ### data LogError monitoring ###
+    ################################
+    parser_data = subparsers.add_parser('data', help='Monitor data taking')
+    addDataArguments(parser_data)
+    parser_data.set_defaults(submit=dataMonitor)
+
+    #########################
+    ### relval monitoring ###
+    #########################
+    parser_relval = subparsers.add_parser('relval', help='Monitor relval workflows')
+    addRelvalArguments(parser_relval)
     parser_relval.set_defaults(submit=relvalMonitor)
 
+    ##########################
+    ### continuous polling ###
+    ##########################
+    parser_watch = subparsers.add_parser('watch', help='Stay resident and process new files as they appear')
+    parser_watch.add_argument('--interval', type=int, default=600, help='Seconds between polls')
+    parser_watch.add_argument('--max-interval', type=int, default=3600, help='Longest wait between polls after failures')
+    parser_watch.add_argument('--queue-size', type=int, default=1000, help='Maximum number of files queued per poll')
+
+    watch_subparsers = parser_watch.add_subparsers(help='Log monitor mode to watch')
+    parser_watch_data = watch_subparsers.add_parser('data', help='Watch data taking')
+    addDataArguments(parser_watch_data)
+    parser_watch_data.set_defaults(submit=watchMonitor,mode='data')
+    parser_watch_relval = watch_subparsers.add_parser('relval', help='Watch relval workflows')
+    addRelvalArguments(parser_watch_relval)
+    parser_watch_relval.set_defaults(submit=watchMonitor,mode='relval')
+
+    ############
+    ### test ###
+    ############
+    parser_test = subparsers.add_parser('test', help='Run the offline watch test')
+    parser_test.set_defaults(submit=watchTest)
+
     parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
 
     return parser.parse_args(argv)
@@ -1,12 +1,16 @@
 from __future__ import print_function
 
+import sys
 import random
 import string
+import argparse
+import cgi
 import json
+import threading
 import cherrypy
-from copy import deepcopy
+from collections import OrderedDict
 
-from getReport import getReport
+from getReport import getSummary, getReportRows, getComparison, getLogMonitorClient, cliOptions
 
 
 @cherrypy.expose
@@ -20,19 +24,166 @@ class HelloWorld(object):
         else:
             return 'Hello World!'
 
+class ResultCache(object):
+    '''Least recently used cache of query results, emptied when the database generation changes'''
+
+    def __init__(self,maxsize=256):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def get(self,key,generation):
+        with self.lock:
+            if generation!=self.generation:
+                self.results.clear()
+                self.generation = generation
+                return None
+            if key not in self.results: return None
+            value = self.results.pop(key)
+            self.results[key] = value
+            return value
+
+    def put(self,key,generation,value):
+        with self.lock:
+            if generation!=self.generation: return
+            self.results[key] = value
+            while len(self.results)>self.maxsize:
+                self.results.popitem(last=False)
+
 @cherrypy.expose
 class LogMonitor(object):
 
+    def __init__(self):
+        self.cache = ResultCache()
+
+    # results with more rows are paginated by the server
+    serverSideRows = 5000
+    # number of table rows per streamed chunk
+    chunkRows = 500
+
     @cherrypy.expose
     def index(self,**kwargs):
         query = kwargs.get('query',None)
         if query:
             args = self.parse(query)
-            result = getReport(**args)
-            content = self.makeTable(json.loads(result),**args)
-            return self.getPage(query,content)
+            try:
+                result = self.getSummary(**args)
+            except ValueError as e:
+                return self.getPage(query,'<pre>{0}</pre>'.format(cgi.escape(str(e))))
+            items = self.getRows(result)
+            if len(items)>self.serverSideRows:
+                options = {'serverSide': True, 'processing': True, 'ajax': self.makeURL('rows',**args)}
+                return self.streamPage(query,self.makeTable({},**args),options)
+            return self.streamPage(query,self.streamTable(items,**args))
         else:
             return self.getPage('','')
+    index._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def rows(self,**kwargs):
+        '''Paginated table rows for DataTables in serverSide mode'''
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        args = self.parse(kwargs.get('query',''))
+        draw = 0
+        try:
+            draw = self.getInt(kwargs,'draw',0)
+            start = max(self.getInt(kwargs,'start',0),0)
+            # a negative length shows all rows
+            length = max(self.getInt(kwargs,'length',10),-1)
+            # columns are log_key, module, severity, count
+            column = self.getInt(kwargs,'order[0][column]',3)
+            if column not in range(4): raise ValueError('Invalid parameter: order[0][column]={0}'.format(column))
+            search = kwargs.get('search[value]','')
+            descending = kwargs.get('order[0][dir]','desc')=='desc'
+            items = self.getRows(self.getSummary(**args))
+        except ValueError as e:
+            return json.dumps({'draw': draw, 'error': str(e)})
+        rows = [(errorName,moduleName,errorType,count) for (errorType,errorName,moduleName),count in items.iteritems()]
+        total = len(rows)
+        if search:
+            rows = [row for row in rows if any([search in field for field in row[:3]])]
+        rows.sort(key=lambda row: row[column],reverse=descending)
+        templates = self.makeRowTemplates(**args)
+        data = [self.makeCells(templates,*row) for row in rows[start:start+length if length>=0 else None]]
+        return json.dumps({'draw': draw, 'recordsTotal': total, 'recordsFiltered': len(rows), 'data': data})
+
+    def getInt(self,kwargs,key,default):
+        '''Integer parameter, raises ValueError naming the parameter if it is not a number'''
+        try:
+            return int(kwargs.get(key,default))
+        except ValueError:
+            raise ValueError('Invalid parameter: {0}={1}'.format(key,kwargs[key]))
+
+    @cherrypy.expose
+    def api(self,**kwargs):
+        '''
+        JSON rows for the getReport keys.
+        limit, offset, order_by (dataset, severity, log_key, module, count), order (asc, desc),
+        merge_datasets and top=N are applied in the database.
+        '''
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        options = {}
+        try:
+            self.checkOptions(kwargs)
+            for key in ['limit','offset','top']:
+                if key in kwargs: options[key] = int(kwargs.pop(key))
+            if 'order_by' in kwargs: options['order_by'] = kwargs.pop('order_by')
+            options['descending'] = kwargs.pop('order','desc')!='asc'
+            options['merge_datasets'] = kwargs.pop('merge_datasets','0').lower() in ['1','true','yes']
+            key = 'api '+self.makeQuery(**dict(kwargs.items()+options.items()))
+            generation = getLogMonitorClient().getGeneration()
+            rows = self.cache.get(key,generation)
+            if rows is None:
+                rows = getReportRows(**dict(kwargs.items()+options.items()))
+                self.cache.put(key,generation,rows)
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return json.dumps({'error': str(e)})
+        return json.dumps({'rows': rows, 'offset': options.get('offset',0), 'limit': options.get('limit',options.get('top'))})
+
+    @cherrypy.expose
+    def compare(self,**kwargs):
+        '''
+        JSON comparison of two dataset patterns, baseline= and target=, per severity, log_key, module.
+        normalize (file, none), severity, module, log_key, limit, offset, order_by, order and top=N are applied in the database.
+        '''
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        options = {}
+        try:
+            self.checkOptions(kwargs)
+            for key in ['baseline','target']:
+                if key not in kwargs: raise ValueError('Missing parameter: {0}'.format(key))
+            for key in ['limit','offset','top']:
+                if key in kwargs: options[key] = int(kwargs.pop(key))
+            if 'order_by' in kwargs: options['order_by'] = kwargs.pop('order_by')
+            options['descending'] = kwargs.pop('order','desc')!='asc'
+            key = 'compare '+self.makeQuery(**dict(kwargs.items()+options.items()))
+            generation = getLogMonitorClient().getGeneration()
+            rows = self.cache.get(key,generation)
+            if rows is None:
+                rows = getComparison(**dict(kwargs.items()+options.items()))
+                self.cache.put(key,generation,rows)
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return json.dumps({'error': str(e)})
+        return json.dumps({'rows': rows, 'offset': options.get('offset',0), 'limit': options.get('limit',options.get('top'))})
+
+    def checkOptions(self,kwargs):
+        '''The command line options of getReport select engines, files and logging of the server, they are refused'''
+        refused = sorted([key for key in kwargs if key in cliOptions])
+        if refused: raise ValueError('Unknown parameter: {0}'.format(', '.join(refused)))
+
+    def getSummary(self,**kwargs):
+        '''Cached getSummary keyed by the normalized query'''
+        self.checkOptions(kwargs)
+        key = self.makeQuery(**kwargs)
+        generation = getLogMonitorClient().getGeneration()
+        result = self.cache.get(key,generation)
+        if result is None:
+            result = getSummary(**kwargs)
+            self.cache.put(key,generation,result)
+        return result
 
     def getRows(self,content,**kwargs):
         '''Get the row content as a dictionary of tuples to counts'''
@@ -46,7 +197,7 @@ class LogMonitor(object):
                         result[key] += count
         return result
 
-    def makeTable(self,content,**kwargs):
+    def makeTableHead(self):
         result = ''
         result += '<table id="logtable" class="table table-striped table-sortable table-bordered" cellspacing="0" width="100%">'
         result += '<thead>'
@@ -58,30 +209,58 @@ class LogMonitor(object):
         result += '</tr>'
         result += '</thead>'
         result += '<tbody>'
-        items = self.getRows(content)
+        return result
+
+    def makeTableFoot(self):
+        return '</tbody></table><br/>'
+
+    def makeRowTemplates(self,**kwargs):
+        '''
+        Precompute the links of the log_key, module and severity cells.
+        The new component always sorts at the same place among the others,
+        so each link is a fixed prefix and suffix around it.
+        '''
+        templates = {}
+        for key in ['log_key','module','severity']:
+            component = '{0}='.format(key)
+            others = sorted(['{0}={1}'.format(k,v) for k,v in kwargs.iteritems() if k!=key])
+            before = [o for o in others if o<component]
+            after = [o for o in others if o>component]
+            templates[key] = (
+                '?query='+''.join([o+'+' for o in before])+component,
+                ''.join(['+'+o for o in after]),
+            )
+        return templates
+
+    def makeCells(self,templates,errorName,moduleName,errorType,count):
+        cells = []
+        for key,val in [('log_key',errorName),('module',moduleName),('severity',errorType)]:
+            prefix, suffix = templates[key]
+            cells += ['<a href="{0}{1}{2}">{1}</a>'.format(prefix,val,suffix)]
+        cells += [count]
+        return cells
+
+    def streamTable(self,items,**kwargs):
+        '''Yield the table in chunks of chunkRows rows'''
+        yield self.makeTableHead()
+        templates = self.makeRowTemplates(**kwargs)
+        chunk = []
         for item,count in items.iteritems():
             errorType,errorName,moduleName = item
-            result += '<tr>'
-            newargs = deepcopy(kwargs)
-            newargs.update({'log_key':errorName})
-            result += '<td><a href="{0}">{1}</a></td>'.format(self.makeURL(**newargs),errorName)
-            newargs = deepcopy(kwargs)
-            newargs.update({'module':moduleName})
-            result += '<td><a href="{0}">{1}</a></td>'.format(self.makeURL(**newargs),moduleName)
-            newargs = deepcopy(kwargs)
-            newargs.update({'severity':errorType})
-            result += '<td><a href="{0}">{1}</a></td>'.format(self.makeURL(**newargs),errorType)
-            result += '<td>{0}</td>'.format(count)
-            result += '</tr>'
-        result += '</tbody>'
-        result += '</table>'
-        result += '<br/>'
-        
-        return result
+            cells = self.makeCells(templates,errorName,moduleName,errorType,count)
+            chunk += ['<tr>'+''.join(['<td>{0}</td>'.format(cell) for cell in cells])+'</tr>']
+            if len(chunk)>=self.chunkRows:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk)
+        yield self.makeTableFoot()
+
+    def makeTable(self,content,**kwargs):
+        return ''.join(self.streamTable(self.getRows(content),**kwargs))
+
+    def makeURL(self,path='',**kwargs):
+        return path+'?query='+'+'.join(self.makeQuery(**kwargs).split(' '))
 
-    def makeURL(self,**kwargs):
-        return '?query='+'+'.join(self.makeQuery(**kwargs).split(' '))
-                        
     def makeQuery(self,**kwargs):
         return ' '.join(sorted(['{0}={1}'.format(key,val) for key,val in kwargs.iteritems()]))
 
@@ -99,9 +278,10 @@ class LogMonitor(object):
               Query: <input type="text" size="80" value="{0}" name="query" />
               <button type="submit">Submit</button>
             </form>
+            <small>Space separated <code>key=val</code> pairs, <code>*</code> matches any characters and matching is case-sensitive, e.g. <code>dataset=/*/Run2016B*/* severity=ERROR</code></small>
         '''.format(query)
 
-    def getPage(self,query,content):
+    def getHeader(self,query,options=None):
         result = """
 <html>
   <head>
@@ -114,18 +294,32 @@ class LogMonitor(object):
   </head>
   <script>
 $(document).ready(function() {
-    $('#logtable').DataTable();
+    $('#logtable').DataTable(%s);
 } );
   </script>
   <body>
-"""
+""" % json.dumps(options or {})
         result += self.getForm(query)
         result += '<br/>'
-        result += content
-        result += """
+        return result
+
+    def getFooter(self):
+        return """
   </body>
 </html>"""
-        return result
+
+    def streamPage(self,query,content,options=None):
+        '''Yield the page, content is a string or an iterable of strings'''
+        yield self.getHeader(query,options)
+        if isinstance(content,basestring):
+            yield content
+        else:
+            for chunk in content:
+                yield chunk
+        yield self.getFooter()
+
+    def getPage(self,query,content):
+        return ''.join(self.streamPage(query,content))
 
     def parse(self,query):
         # TODO: validate
@@ -139,10 +333,24 @@ $(document).ready(function() {
         return kwargs
 
 
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Web frontend for log monitoring')
+
+    parser.add_argument('--host', type=str, default='dntaylor-test.cern.ch', help='Host name to bind')
+    parser.add_argument('--port', type=int, default=80, help='Port to bind')
+    parser.add_argument('--threads', type=int, default=30, help='Number of request handling threads')
+    parser.add_argument('--queue-size', type=int, default=100, help='Number of connections queued while all threads are busy')
+
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
+    args = parse_command_line(sys.argv[1:])
+
     global_conf = {
-        'server.socket_host': 'dntaylor-test.cern.ch',
-        'server.socket_port': 80,
+        'server.socket_host': args.host,
+        'server.socket_port': args.port,
+        'server.thread_pool': args.threads,
+        'server.socket_queue_size': args.queue_size,
     }
     cherrypy.config.update(global_conf)
 
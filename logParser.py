@@ -0,0 +1,110 @@
+import os
+import re
+import time
+import tarfile
+from collections import Counter
+
+from metrics import Metrics, MeteredFile
+
+# MessageLogger header: %MSG-e Category:  Module:label  date run event, found anywhere in the line
+MESSAGE = re.compile(br'\s*\S*MSG-([ew])\S*(?:\s+(\S+))?(?:\s+(\S+))?')
+SEVERITIES = {
+    b'e' : 'Error',
+    b'w' : 'Warning',
+}
+BLOCKSIZE = 1 << 20
+
+def readLines(fileobj,blocksize=BLOCKSIZE):
+    '''Iterate over the lines of a binary file object, reading it in large blocks'''
+    rest = b''
+    while True:
+        block = fileobj.read(blocksize)
+        if not block: break
+        lines = (rest+block).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest: yield rest
+
+def parseLogFile(results,content):
+    '''
+    Count the LogErrors and LogWarnings of a CMSSW stdout log.
+    content is an iterable of byte lines.
+    results is a Counter keyed by (severity, log_key, module), it is updated and returned.
+    '''
+    if results is None: results = Counter()
+    search = MESSAGE.search
+    for line in content:
+        if b'MSG-' not in line: continue
+        if b'MemoryCheck:' in line: continue
+        m = search(line)
+        if not m: continue
+        sev, log_key, module = m.groups()
+        log_key = log_key.strip(b':') if log_key else 'unknown'
+        results[(SEVERITIES[sev],log_key,module or 'unknown')] += 1
+    return results
+
+def aggregateErrorSummary(results,entries):
+    '''
+    Sum the counts of edm::ErrorSummaryEntry objects, skipping the MemoryCheck category.
+    entries is an iterable of objects with severity.getName(), category, module and count.
+    results is a Counter keyed by (severity, category, module), it is updated and returned.
+    '''
+    if results is None: results = Counter()
+    for es in entries:
+        category = es.category
+        if category=='MemoryCheck': continue
+        results[(es.severity.getName(),category,es.module)] += es.count
+    return results
+
+def parseFrameworkJobReport(content):
+    return
+    print content
+    
+def iterLogCollect(eospath,fileobj=None):
+    '''
+    Stream the log files of a LogCollect tarball, yields (filename, fileobj).
+    Both archives are read sequentially without building their index,
+    so each fileobj must be consumed before the next one is requested.
+    '''
+    with tarfile.open(eospath,mode='r|*',fileobj=fileobj) as tf:
+        for member in tf:
+            if not member.isfile(): continue
+            tfg_f = tf.extractfile(member)
+            with tarfile.open(fileobj=tfg_f,mode='r|*') as tfg:
+                for mem in tfg:
+                    filename, ftype = os.path.splitext(mem.name)
+                    if ftype not in ['.log','.xml']: continue
+                    if not mem.isfile(): continue
+                    yield filename, tfg.extractfile(mem)
+            break # only the first member holds the logs
+
+def readLogCollect(eospath,metrics=None):
+    '''
+    Parse the stdout logs in a LogCollect tarball, returns a Counter keyed by (severity, log_key, module).
+    The open, read, extract and parse stages are recorded in metrics.
+    '''
+    if metrics is None: metrics = Metrics()
+    results = Counter()
+    with metrics.timer('open'):
+        raw = MeteredFile(open(eospath,'rb'))
+    try:
+        for filename, log_f in iterLogCollect(eospath,fileobj=raw):
+            if 'FrameworkJobReport' in filename:
+                content = log_f.read()
+                parseFrameworkJobReport(content)
+            if 'stdout' in filename:
+                # lines are fed to the parser as they are read,
+                # reading the tarball is split from decompressing it and from parsing
+                log_f = MeteredFile(log_f)
+                remote = raw.seconds
+                start = time.time()
+                results = parseLogFile(results,readLines(log_f))
+                elapsed = time.time()-start
+                remote = raw.seconds-remote
+                metrics.record('extract',log_f.seconds-remote,bytes=log_f.bytes)
+                metrics.record('parse',elapsed-log_f.seconds,bytes=log_f.bytes,lines=log_f.lines)
+    finally:
+        raw.close()
+    metrics.record('read',raw.seconds,bytes=raw.bytes)
+    return results
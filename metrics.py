@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import json
+import logging
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+def percentile(values,fraction):
+    '''Nearest-rank percentile of a sorted list'''
+    if not values: return 0
+    index = int(round(fraction*(len(values)-1)))
+    return values[index]
+
+def summarize(samples):
+    '''
+    Histogram of the samples per stage: count, total, p50, p95 and max seconds,
+    the summed counts (bytes, lines, rows) and their rates.
+    '''
+    stages = {}
+    for stage, seconds, counts in samples:
+        if stage not in stages: stages[stage] = {'times':[],'counts':{}}
+        stages[stage]['times'] += [seconds]
+        for key,val in counts.iteritems():
+            stages[stage]['counts'][key] = stages[stage]['counts'].get(key,0)+val
+    summary = {}
+    for stage,values in stages.iteritems():
+        times = sorted(values['times'])
+        total = sum(times)
+        summary[stage] = {
+            'count' : len(times),
+            'seconds' : total,
+            'p50' : percentile(times,0.5),
+            'p95' : percentile(times,0.95),
+            'max' : times[-1],
+        }
+        for key,val in values['counts'].iteritems():
+            summary[stage][key] = val
+            summary[stage]['{0}_per_second'.format(key)] = val/total if total else 0
+    return summary
+
+class Metrics(object):
+    '''
+    Timings of the pipeline stages with the bytes, lines or rows they processed.
+    Records are appended as JSON lines to path, the run summary can also be
+    written as a Prometheus textfile.
+    '''
+
+    def __init__(self,path='',prometheus=''):
+        self.path = path
+        self.prometheus = prometheus
+        self.samples = []
+        self.start = time.time()
+        self.output = open(path,'a') if path else None
+
+    def record(self,stage,seconds,**counts):
+        self.samples += [(stage,seconds,counts)]
+
+    def extend(self,samples):
+        self.samples += [tuple(sample) for sample in samples]
+
+    @contextmanager
+    def timer(self,stage):
+        '''Time a block, the yielded dictionary holds the counts of what it processed'''
+        counts = {}
+        start = time.time()
+        try:
+            yield counts
+        finally:
+            self.record(stage,time.time()-start,**counts)
+
+    def log(self,**record):
+        if not self.output: return
+        record['time'] = time.time()
+        self.output.write(json.dumps(record,sort_keys=True)+'\n')
+        self.output.flush()
+
+    def close(self):
+        '''Write the run summary, returns it'''
+        summary = summarize(self.samples)
+        seconds = time.time()-self.start
+        self.log(type='run',seconds=seconds,stages=summary)
+        if self.prometheus: writePrometheus(self.prometheus,summary,seconds)
+        if self.output: self.output.close()
+        self.output = None
+        return summary
+
+def writePrometheus(path,summary,seconds):
+    '''Write the run summary in the Prometheus textfile format, replacing the file atomically'''
+    lines = [
+        '# HELP logmonitor_stage_seconds Time spent in a pipeline stage per file or call.',
+        '# TYPE logmonitor_stage_seconds summary',
+    ]
+    for stage in sorted(summary):
+        values = summary[stage]
+        lines += ['logmonitor_stage_seconds{{stage="{0}",quantile="0.5"}} {1}'.format(stage,values['p50'])]
+        lines += ['logmonitor_stage_seconds{{stage="{0}",quantile="0.95"}} {1}'.format(stage,values['p95'])]
+        lines += ['logmonitor_stage_seconds_sum{{stage="{0}"}} {1}'.format(stage,values['seconds'])]
+        lines += ['logmonitor_stage_seconds_count{{stage="{0}"}} {1}'.format(stage,values['count'])]
+    lines += [
+        '# HELP logmonitor_stage_max_seconds Longest time spent in a pipeline stage.',
+        '# TYPE logmonitor_stage_max_seconds gauge',
+    ]
+    lines += ['logmonitor_stage_max_seconds{{stage="{0}"}} {1}'.format(stage,summary[stage]['max']) for stage in sorted(summary)]
+    for key in ['bytes','lines','rows']:
+        lines += [
+            '# HELP logmonitor_stage_{0}_total Number of {0} processed by a pipeline stage.'.format(key),
+            '# TYPE logmonitor_stage_{0}_total counter'.format(key),
+        ]
+        lines += ['logmonitor_stage_{0}_total{{stage="{1}"}} {2}'.format(key,stage,summary[stage][key]) for stage in sorted(summary) if key in summary[stage]]
+    lines += [
+        '# HELP logmonitor_run_seconds Duration of the last run.',
+        '# TYPE logmonitor_run_seconds gauge',
+        'logmonitor_run_seconds {0}'.format(seconds),
+        '# HELP logmonitor_last_run_timestamp_seconds End of the last run.',
+        '# TYPE logmonitor_last_run_timestamp_seconds gauge',
+        'logmonitor_last_run_timestamp_seconds {0}'.format(time.time()),
+    ]
+    tmp = '{0}.tmp'.format(path)
+    with open(tmp,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    os.rename(tmp,path)
+
+class MeteredClient(object):
+    '''Wrap a client so the time of every method call is recorded as a stage'''
+
+    def __init__(self,client,metrics,stage):
+        self.client = client
+        self.metrics = metrics
+        self.stage = stage
+
+    def __getattr__(self,method):
+        func = getattr(self.client,method)
+        if not callable(func): return func
+
+        def meteredCall(*args,**kwargs):
+            with self.metrics.timer(self.stage):
+                return func(*args,**kwargs)
+
+        return meteredCall
+
+class MeteredFile(object):
+    '''File object wrapper counting the bytes and lines read and the time spent reading'''
+
+    def __init__(self,fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+        self.lines = 0
+        self.seconds = 0.
+
+    def read(self,size=-1):
+        start = time.time()
+        data = self.fileobj.read(size)
+        self.seconds += time.time()-start
+        self.bytes += len(data)
+        self.lines += data.count(b'\n')
+        return data
+
+    def __getattr__(self,attr):
+        return getattr(self.fileobj,attr)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+MINUTE = 60
+HOUR = 60*MINUTE
+DAY = 24*HOUR
+
+# request states after which a ReqMgr request no longer changes
+FINAL_STATES = ['completed','closed-out','announced','normal-archived','aborted-archived','rejected-archived']
+
+def isFinished(result):
+    '''Check if all requests of a ReqMgr result are in a final state'''
+    statuses = [v.get('RequestStatus','') for r in result for v in r.values() if isinstance(v,dict)]
+    return bool(statuses) and all([s in FINAL_STATES for s in statuses])
+
+def requestTTL(result):
+    '''Cache finished ReqMgr requests for a long time, requests still running only briefly'''
+    return 30*DAY if isFinished(result) else HOUR
+
+def finishedRequestTTL(result):
+    '''Cache only finished ReqMgr requests, running ones can still get new output datasets'''
+    return 30*DAY if isFinished(result) else 0
+
+# time to live in seconds per endpoint, either a number or a function of the result
+# dataset searches are wildcard patterns that match newly published datasets, they are only kept briefly
+DEFAULT_TTLS = {
+    'dbs.listDatasets' : 10*MINUTE,
+    'dbs.listFiles'    : HOUR,
+    'reqmgr.get'       : requestTTL,
+}
+# a watcher must see new datasets and changed requests on the next poll, so only immutable responses are cached
+WATCH_TTLS = {
+    'reqmgr.get'       : finishedRequestTTL,
+}
+
+class ResponseCache(object):
+    '''
+    On-disk cache of remote responses with per-endpoint time to live and least recently used eviction.
+    The cache is in WAL mode and hits only read, the access time of an entry is written at most once per accessResolution seconds,
+    so the threads of a server answering from the cache do not wait for each other.
+    '''
+
+    def __init__(self,sqlfile,ttls=None,maxEntries=10000,refresh=False,accessResolution=MINUTE,timeout=30):
+        self.sqlfile = sqlfile
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.maxEntries = maxEntries
+        self.refresh = refresh
+        self.accessResolution = accessResolution
+        self.timeout = timeout
+        self.local = threading.local()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT, value TEXT, expires REAL, accessed REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    @property
+    def conn(self):
+        '''Connection of the current thread, so cached clients can be called from a thread pool'''
+        if not hasattr(self.local,'conn'):
+            # writers wait up to timeout seconds for the lock instead of failing
+            conn = sqlite3.connect(self.sqlfile,isolation_level=None,timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return self.local.conn
+
+    def makeKey(self,endpoint,*args,**kwargs):
+        return json.dumps([endpoint,args,kwargs],sort_keys=True)
+
+    def cached(self,endpoint):
+        return endpoint in self.ttls
+
+    def ttl(self,endpoint,value):
+        '''Time to live of a value, zero if it is not cached'''
+        ttl = self.ttls[endpoint]
+        return ttl(value) if callable(ttl) else ttl
+
+    def get(self,key):
+        '''Returns (hit, value), refresh mode always misses'''
+        if self.refresh: return False, None
+        now = time.time()
+        row = self.conn.execute('SELECT value, expires, accessed FROM responses WHERE key=?',(key,)).fetchone()
+        if row is None or row[1] < now: return False, None
+        if now-row[2] >= self.accessResolution:
+            self.conn.execute('UPDATE responses SET accessed=? WHERE key=?',(now,key))
+        return True, json.loads(row[0])
+
+    def put(self,endpoint,key,value):
+        ttl = self.ttl(endpoint,value)
+        if not ttl: return
+        now = time.time()
+        self.conn.execute('INSERT OR REPLACE INTO responses (key, endpoint, value, expires, accessed) VALUES (?, ?, ?, ?, ?)',(key,endpoint,json.dumps(value),now+ttl,now))
+        self.evict()
+
+    def evict(self):
+        '''Remove expired entries and the least recently used ones beyond maxEntries'''
+        self.conn.execute('DELETE FROM responses WHERE expires<?',(time.time(),))
+        self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',(self.maxEntries,))
+
+    def clear(self):
+        self.conn.execute('DELETE FROM responses')
+
+class CachedClient(object):
+    '''Wrap a client so the methods with a time to live are answered from the cache'''
+
+    def __init__(self,client,cache,name):
+        self.client = client
+        self.cache = cache
+        self.name = name
+
+    def __getattr__(self,method):
+        func = getattr(self.client,method)
+        endpoint = '{0}.{1}'.format(self.name,method)
+        if not callable(func) or not self.cache.cached(endpoint): return func
+
+        def cachedCall(*args,**kwargs):
+            key = self.cache.makeKey(endpoint,*args,**kwargs)
+            hit, value = self.cache.get(key)
+            # entries written with other time to live settings are only used if they would be cached here
+            if hit and self.cache.ttl(endpoint,value):
+                logging.debug('Cache hit {0}'.format(key))
+                return value
+            value = func(*args,**kwargs)
+            self.cache.put(endpoint,key,value)
+            return value
+
+        return cachedCall
+
+class FakeClient(object):
+    '''
+    Offline stand-in for the DBS and ReqMgr clients.
+    responses maps a method name to a fixed result or to a function called with the arguments.
+    Every call is recorded in calls.
+    '''
+
+    def __init__(self,**responses):
+        self.responses = responses
+        self.calls = []
+
+    def __getattr__(self,method):
+        if method not in self.responses: raise AttributeError(method)
+        response = self.responses[method]
+
+        def fakeCall(*args,**kwargs):
+            self.calls += [(method,args,kwargs)]
+            return response(*args,**kwargs) if callable(response) else response
+
+        return fakeCall
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Cache of remote responses, runs the unit tests by default')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    logging.getLogger().setLevel(logging.DEBUG)
+    failures = []
+    def check(name,ok):
+        print name, 'OK' if ok else 'FAILED'
+        if not ok: failures.append(name)
+
+    sqlfile = 'test-responseCache.sqlite'
+    if os.path.exists(sqlfile): os.remove(sqlfile)
+
+    # requests are cached for long only once they are finished
+    running = [{'req1':{'RequestStatus':'running-open'}}]
+    finished = [{'req1':{'RequestStatus':'announced'}},{'req2':{'RequestStatus':'normal-archived'}}]
+    check('running request ttl',requestTTL(running)==HOUR)
+    check('finished request ttl',requestTTL(finished)==30*DAY)
+    check('mixed request ttl',requestTTL(running+finished)==HOUR)
+    check('empty request ttl',requestTTL([])==HOUR)
+    check('watch running request not cached',finishedRequestTTL(running)==0)
+    check('watch finished request ttl',finishedRequestTTL(finished)==30*DAY)
+
+    # repeated calls are answered from the cache until they expire
+    fake = FakeClient(listDatasets=lambda dataset: [{'dataset':dataset}],listRuns=[])
+    cache = ResponseCache(sqlfile,ttls={'dbs.listDatasets':0.5})
+    client = CachedClient(fake,cache,'dbs')
+    client.listDatasets(dataset='/a/*/c')
+    client.listDatasets(dataset='/a/*/c')
+    check('cache hit',len(fake.calls)==1)
+    client.listDatasets(dataset='/b/*/c')
+    check('different arguments miss',len(fake.calls)==2)
+    client.listRuns()
+    client.listRuns()
+    check('endpoint without ttl not cached',len(fake.calls)==4)
+    time.sleep(0.6)
+    client.listDatasets(dataset='/a/*/c')
+    check('expired entry miss',len(fake.calls)==5)
+
+    # refresh always calls the client and updates the cache
+    refreshed = CachedClient(fake,ResponseCache(sqlfile,ttls={'dbs.listDatasets':60},refresh=True),'dbs')
+    refreshed.listDatasets(dataset='/c/*/c')
+    refreshed.listDatasets(dataset='/c/*/c')
+    check('refresh misses',len(fake.calls)==7)
+    CachedClient(fake,ResponseCache(sqlfile,ttls={'dbs.listDatasets':60}),'dbs').listDatasets(dataset='/c/*/c')
+    check('refresh stores',len(fake.calls)==7)
+
+    # the least recently used entries are evicted beyond maxEntries
+    cache = ResponseCache(sqlfile,ttls={'dbs.listDatasets':60},maxEntries=3,accessResolution=0)
+    cache.clear()
+    client = CachedClient(fake,cache,'dbs')
+    for ds in ['/1/*/c','/2/*/c','/3/*/c']:
+        client.listDatasets(dataset=ds)
+        time.sleep(0.01)
+    client.listDatasets(dataset='/1/*/c')
+    time.sleep(0.01)
+    client.listDatasets(dataset='/4/*/c')
+    keys = [cache.makeKey('dbs.listDatasets',dataset=ds) for ds in ['/1/*/c','/2/*/c','/3/*/c','/4/*/c']]
+    check('lru evicted',[cache.get(key)[0] for key in keys]==[True,False,True,True])
+
+    # a running request cached with the default ttls is looked up again by a watcher
+    reqmgr = FakeClient(get=running)
+    CachedClient(reqmgr,ResponseCache(sqlfile),'reqmgr').get(name='req1')
+    CachedClient(reqmgr,ResponseCache(sqlfile),'reqmgr').get(name='req1')
+    CachedClient(reqmgr,ResponseCache(sqlfile,ttls=WATCH_TTLS),'reqmgr').get(name='req1')
+    check('watch ignores running requests',len(reqmgr.calls)==2)
+
+    # hits within the access resolution do not write
+    cache = ResponseCache(sqlfile,ttls={'dbs.listDatasets':60})
+    key = keys[0]
+    changes = cache.conn.total_changes
+    cache.get(key)
+    check('hit without write',cache.conn.total_changes==changes)
+
+    for suffix in ['','-wal','-shm']:
+        if os.path.exists(sqlfile+suffix): os.remove(sqlfile+suffix)
+    if failures: return 1
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from LogMonitorAPI import LogMonitorAPI, LAYOUTS
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+CATALOG = 'catalog.sqlite'
+SHARDS = 'logMonitor.shards'
+
+def getDatabase():
+    '''Database in the working directory, the directory of shards is used instead of logMonitor.sqlite if it exists'''
+    return SHARDS if os.path.isdir(SHARDS) else 'logMonitor.sqlite'
+
+def openLogMonitor(path,**kwargs):
+    '''ShardedLogMonitorAPI for a directory of shards, LogMonitorAPI for a database file'''
+    if os.path.isdir(path): return ShardedLogMonitorAPI(path,**kwargs)
+    return LogMonitorAPI(path,**kwargs)
+
+def getEra(dataset):
+    '''Acquisition era of a dataset name, /Primary/Run2016B-PromptReco-v1/RECO -> Run2016B'''
+    parts = dataset.split('/')
+    if len(parts)<3: return 'unknown'
+    return parts[2].split('-')[0] or 'unknown'
+
+def matchesShard(shard,dataset):
+    '''
+    Check if a shard can hold datasets matching a pattern, from the era in the pattern and the dataset boundaries of the shard.
+    Lists are matched exactly, like in LogMonitorAPI.
+    '''
+    if isinstance(dataset,(list,tuple,set)):
+        return any([matchesShard(shard,ds) for ds in dataset if '*' not in ds] or [True])
+    if shard['shard']=='unknown': return True
+    # a prefix without wildcards must fall within the boundaries
+    prefix = dataset.split('*')[0]
+    if prefix and (shard['last_dataset']<prefix or shard['first_dataset'][:len(prefix)]>prefix): return False
+    # with three components the wildcards cannot match a '/', so the era is in the second one
+    parts = dataset.split('/')
+    if len(parts)!=4 or parts[0]: return True
+    era = parts[2].split('-')[0]
+    if '*' in era: return shard['shard'].startswith(era[:era.index('*')])
+    return shard['shard']==era
+
+def rankRows(rows,columns,order_by=None,descending=True,limit=None,offset=0):
+    '''Same ordering and limits as LogMonitorAPI, order_by first and the other columns ascending'''
+    if order_by:
+        if order_by not in columns: raise ValueError('Cannot order by {0}, valid columns are {1}'.format(order_by,columns))
+        rows = sorted(rows,key=lambda row: [row[c] for c in columns if c!=order_by])
+        rows = sorted(rows,key=lambda row: row[order_by],reverse=descending)
+    if limit is not None or offset:
+        rows = rows[offset:None if limit is None else offset+limit]
+    return rows
+
+class ShardedLogMonitorAPI(object):
+    '''
+    LogMonitorAPI over a directory of databases, one shard per acquisition era of the dataset names.
+    The catalog database holds the shards with their dataset boundaries, the work journal and the metadata.
+    Each shard is a LogMonitorAPI database with the files, log counts, rollups and high-water marks of its datasets.
+    Writes are routed by dataset, reads run on the shards matching the dataset pattern in parallel.
+    '''
+
+    def __init__(self,path,explain=False,readonly=False,layout=None,threads=8):
+        self.path = path
+        self.explain = explain
+        self.readonly = readonly
+        self.threads = threads
+        if not readonly and not os.path.isdir(path): os.makedirs(path)
+        self.catalog = LogMonitorAPI(os.path.join(path,CATALOG),explain=explain,readonly=readonly,catalog=True)
+        self.shards = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = None
+        # existing shards keep their layout, new ones are normalized by default
+        self.layout = layout
+        shards = self.catalog.listShards()
+        if shards: self.layout = self.__open(shards[0]['shard'],shards[0]['path']).layout
+        if not self.layout: self.layout = 'normalized'
+
+    # transaction depth and module rows waiting for their processed file, per thread
+    @property
+    def depth(self):
+        return getattr(self.local,'depth',0)
+
+    @depth.setter
+    def depth(self,depth):
+        self.local.depth = depth
+
+    @property
+    def pending(self):
+        if not hasattr(self.local,'pending'): self.local.pending = {}
+        return self.local.pending
+
+    @property
+    def routed(self):
+        if not hasattr(self.local,'routed'): self.local.routed = set()
+        return self.local.routed
+
+    def close(self):
+        self.catalog.close()
+        for shard in self.shards.values():
+            shard.close()
+
+    def __open(self,name,path):
+        '''LogMonitorAPI of a shard, opened once'''
+        with self.lock:
+            if name not in self.shards:
+                self.shards[name] = LogMonitorAPI(os.path.join(self.path,path),explain=self.explain,readonly=self.readonly,layout=self.layout)
+            shard = self.shards[name]
+        shard.explain = self.explain
+        return shard
+
+    def __create(self,name,path):
+        '''
+        Create the database of a new shard under a temporary name and rename it once its schema is complete.
+        It is removed again if the transaction recording it in the catalog rolls back.
+        '''
+        fullpath = os.path.join(self.path,path)
+        tmppath = '{0}.tmp'.format(fullpath)
+        self.__remove(tmppath)
+        LogMonitorAPI(tmppath,layout=self.layout).close()
+        os.rename(tmppath,fullpath)
+        self.local.created += [name]
+
+    def __remove(self,fullpath):
+        '''Remove a database with its WAL files'''
+        for suffix in ['','-wal','-shm']:
+            if os.path.exists(fullpath+suffix): os.remove(fullpath+suffix)
+
+    def __route(self,dataset):
+        '''Shard of a dataset, created and recorded in the catalog on first use'''
+        name = getEra(dataset)
+        path = '{0}.sqlite'.format(re.sub('[^A-Za-z0-9_.]','_',name))
+        if not os.path.isfile(os.path.join(self.path,path)): self.__create(name,path)
+        shard = self.__open(name,path)
+        self.__join(shard)
+        self.catalog.insertShard(name,path,dataset)
+        return shard
+
+    def __join(self,api):
+        '''Enter a transaction of api that ends with the current one'''
+        if not self.depth or api in [joined for joined,context in self.local.joined]: return
+        context = api.transaction()
+        context.__enter__()
+        self.local.joined += [(api,context)]
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Group all writes in the block, the shards written to commit at the end of the outermost block, before the catalog.
+        The module rows and processed markers of a file must be inserted in one transaction.
+        '''
+        if self.depth:
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+            return
+        self.depth = 1
+        self.local.joined = []
+        self.local.created = []
+        try:
+            self.__join(self.catalog)
+            yield self
+            self.__flush()
+        except:
+            error = sys.exc_info()
+            for api,context in reversed(self.local.joined):
+                context.__exit__(*error)
+            # the catalog does not know the shards created in the block
+            for name in self.local.created:
+                with self.lock:
+                    shard = self.shards.pop(name)
+                shard.close()
+                self.__remove(shard.sqlfile)
+            raise
+        else:
+            for api,context in reversed(self.local.joined):
+                context.__exit__(None,None,None)
+        finally:
+            self.depth = 0
+            self.local.joined = []
+            self.local.created = []
+            self.pending.clear()
+            self.routed.clear()
+
+    def __select(self,*datasets):
+        '''Shards that can hold datasets matching any of the patterns, all shards without patterns'''
+        shards = sorted(self.catalog.listShards(),key=lambda shard: shard['shard'])
+        datasets = [ds for ds in datasets if ds is not None]
+        if not datasets: return shards
+        return [shard for shard in shards if any([matchesShard(shard,ds) for ds in datasets])]
+
+    def __apis(self,*datasets):
+        '''LogMonitorAPI of each shard that can hold datasets matching the patterns'''
+        return [self.__open(shard['shard'],shard['path']) for shard in self.__select(*datasets)]
+
+    def __map(self,func,shards):
+        '''Results of func on each shard, in parallel if there are several'''
+        if len(shards)<2: return [func(shard) for shard in shards]
+        with self.lock:
+            if self.pool is None: self.pool = ThreadPool(self.threads)
+        return self.pool.map(func,shards)
+
+    ###################
+    ### Insert data ###
+    ###################
+    def insertModule(self,**kwargs):
+        self.insertModules([kwargs])
+
+    def insertModules(self,rows):
+        '''
+        Keep the logMonitor rows until their processed file routes them to a shard.
+        Rows whose processed file is not inserted in the same transaction are routed when it ends, see __flush.
+        '''
+        with self.transaction():
+            for row in rows:
+                self.pending.setdefault(row['file_name'],[]).append(row)
+
+    def insertProcessedFile(self,**kwargs):
+        '''Mark a file processed in the shard of its dataset, together with its logMonitor rows'''
+        with self.transaction():
+            shard = self.__route(kwargs['dataset'])
+            shard.insertModules(self.pending.get(kwargs['file_name'],[]))
+            shard.insertProcessedFile(**kwargs)
+            self.routed.add(kwargs['file_name'])
+
+    def __flush(self):
+        '''
+        Route the pending logMonitor rows of files without a processed file in this transaction:
+        by the dataset column of the rows, to the shards that already hold the file, or else to the unknown shard.
+        '''
+        for file_name,rows in sorted(self.pending.items()):
+            if file_name in self.routed: continue
+            groups = {}
+            for row in rows:
+                groups.setdefault(row.get('dataset'),[]).append(row)
+            for dataset,group in sorted(groups.items()):
+                datasets = [dataset] if dataset else [found['dataset'] for found in self.listProcessedFiles(file_name=file_name)] or ['']
+                for ds in datasets:
+                    self.__route(ds).insertModules(group)
+        self.pending.clear()
+
+    def insertDatasetMark(self,dataset,nfiles,last_modified=0):
+        with self.transaction():
+            self.__route(dataset).insertDatasetMark(dataset,nfiles,last_modified)
+
+    def queueWork(self,tasks):
+        self.catalog.queueWork(tasks)
+
+    def startWork(self,file_name,worker,path,datasets):
+        self.catalog.startWork(file_name,worker,path,datasets)
+
+    def finishWork(self,file_name,error=''):
+        self.catalog.finishWork(file_name,error)
+
+    def setMetadata(self,key,value):
+        self.catalog.setMetadata(key,value)
+
+    def rebuildRollups(self):
+        self.__map(lambda shard: shard.rebuildRollups(),self.__apis())
+
+    def migrate(self,sqlfile):
+        '''
+        Split the processed files, log counts and high-water marks of a single database into the shards of their datasets.
+        The work journal and the metadata are copied to the catalog.
+        '''
+        # opened writable so that older databases get the tables read below
+        old = LogMonitorAPI(sqlfile)
+        eras = {}
+        for row in old.listDatasets():
+            eras.setdefault(getEra(row['dataset']),[]).append(row['dataset'])
+        for row in old.listDatasetMarks():
+            eras.setdefault(getEra(row['dataset']),[]).append(row['dataset'])
+        old.close()
+        self.catalog.migrateState(sqlfile)
+        for era,datasets in sorted(eras.iteritems()):
+            with self.transaction():
+                shard = self.__route(min(datasets))
+                self.catalog.insertShard(era,os.path.basename(shard.sqlfile),max(datasets))
+            shard.migrate(sqlfile,datasets=datasets)
+
+    ##################
+    ### query data ###
+    ##################
+    def listModules(self,**kwargs):
+        return [row for rows in self.__map(lambda shard: shard.listModules(**kwargs),self.__apis()) for row in rows]
+
+    def listProcessedFiles(self,**kwargs):
+        return [row for rows in self.__map(lambda shard: shard.listProcessedFiles(**kwargs),self.__apis(kwargs.get('dataset'))) for row in rows]
+
+    def listWork(self,**kwargs):
+        return self.catalog.listWork(**kwargs)
+
+    def listShards(self,**kwargs):
+        return self.catalog.listShards(**kwargs)
+
+    def getGeneration(self):
+        '''Sum of the shard generations, it grows whenever one of them changes'''
+        return sum(self.__map(lambda shard: shard.getGeneration(),self.__apis()))
+
+    def getMetadata(self,key,default=0):
+        return self.catalog.getMetadata(key,default)
+
+    def getProcessedFileNames(self,**kwargs):
+        return set().union(*self.__map(lambda shard: shard.getProcessedFileNames(**kwargs),self.__apis(kwargs.get('dataset'))))
+
+    def listDatasetMarks(self,**kwargs):
+        return [row for rows in self.__map(lambda shard: shard.listDatasetMarks(**kwargs),self.__apis(kwargs.get('dataset'))) for row in rows]
+
+    def listDatasetTotals(self,**kwargs):
+        return [row for rows in self.__map(lambda shard: shard.listDatasetTotals(**kwargs),self.__apis(kwargs.get('dataset'))) for row in rows]
+
+    def listDatasets(self,**kwargs):
+        return [row for rows in self.__map(lambda shard: shard.listDatasets(**kwargs),self.__apis(kwargs.get('dataset'))) for row in rows]
+
+    def iterProcessedRows(self,batchSize=100000,**kwargs):
+        '''Same as LogMonitorAPI.iterProcessedRows, one shard after the other'''
+        for shard in self.__apis(kwargs.get('dataset')):
+            for rows in shard.iterProcessedRows(batchSize=batchSize,**kwargs):
+                yield rows
+
+    def __summarize(self,method,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+        '''
+        Fan out a summary to the shards and combine the rows.
+        A dataset lives in a single shard, so the shards can order and limit the rows unless datasets are merged.
+        '''
+        shards = self.__apis(kwargs.get('dataset'))
+        if len(shards)==1:
+            return getattr(shards[0],method)(merge_datasets=merge_datasets,order_by=order_by,descending=descending,limit=limit,offset=offset,**kwargs)
+        groups = ['severity', 'log_key', 'module'] if merge_datasets else ['dataset', 'severity', 'log_key', 'module']
+        columns = groups + ['count']
+        if merge_datasets:
+            options = {'merge_datasets':True}
+        else:
+            options = {'order_by':order_by,'descending':descending,'limit':None if limit is None else offset+limit}
+        results = self.__map(lambda shard: getattr(shard,method)(**dict(kwargs.items()+options.items())),shards)
+        rows = {}
+        for result in results:
+            for row in result:
+                key = tuple([row[g] for g in groups])
+                if key in rows:
+                    rows[key]['count'] += row['count']
+                else:
+                    rows[key] = row
+        return rankRows(rows.values(),columns,order_by,descending,limit,offset)
+
+    def summarizeDatasets(self,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+        '''Same as LogMonitorAPI.summarizeDatasets over the shards'''
+        return self.__summarize('summarizeDatasets',merge_datasets,order_by,descending,limit,offset,**kwargs)
+
+    def summarize(self,file_names=None,merge_datasets=False,order_by=None,descending=True,limit=None,offset=0,**kwargs):
+        '''Same as LogMonitorAPI.summarize over the shards'''
+        return self.__summarize('summarize',merge_datasets,order_by,descending,limit,offset,file_names=file_names,**kwargs)
+
+    def compareDatasets(self,baseline,target,normalize='file',order_by='score',descending=True,limit=None,offset=0,**kwargs):
+        '''
+        Same as LogMonitorAPI.compareDatasets.
+        It is a single query if both patterns are in one shard, otherwise the raw counts of the shards are combined here.
+        '''
+        if normalize not in ['file','none']:
+            raise ValueError('Cannot normalize per {0}, valid choices are file and none (event counts are not stored)'.format(normalize))
+        shards = self.__apis(baseline,target)
+        if len(shards)==1:
+            return shards[0].compareDatasets(baseline,target,normalize,order_by,descending,limit,offset,**kwargs)
+        baseFiles, targetFiles = 1, 1
+        if normalize=='file':
+            baseFiles = sum([row['nfiles'] for row in self.listDatasetTotals(dataset=baseline)])
+            targetFiles = sum([row['nfiles'] for row in self.listDatasetTotals(dataset=target)])
+            if not baseFiles or not targetFiles:
+                raise ValueError('No processed files match {0}'.format(baseline if not baseFiles else target))
+        columns = ['severity', 'log_key', 'module', 'base_count', 'target_count', 'base_rate', 'target_rate', 'delta', 'ratio', 'score']
+        rows = {}
+        for result in self.__map(lambda shard: shard.compareDatasets(baseline,target,'none',None,**kwargs),shards):
+            for row in result:
+                key = (row['severity'],row['log_key'],row['module'])
+                if key in rows:
+                    rows[key]['base_count'] += row['base_count']
+                    rows[key]['target_count'] += row['target_count']
+                else:
+                    rows[key] = row
+        for row in rows.values():
+            row['base_rate'] = 1.0*row['base_count']/baseFiles
+            row['target_rate'] = 1.0*row['target_count']/targetFiles
+            row['delta'] = row['target_rate']-row['base_rate']
+            row['ratio'] = row['target_rate']/row['base_rate'] if row['base_rate']>0 else None
+            variance = 1.0*row['target_count']/(targetFiles*targetFiles)+1.0*row['base_count']/(baseFiles*baseFiles)
+            row['score'] = row['delta']*row['delta']/variance if variance else None
+        return rankRows(rows.values(),columns,order_by,descending,limit,offset)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Sharded LogMonitor database, runs the unit tests by default')
+
+    parser.add_argument('--split', type=str, nargs=2, metavar=('DATABASE','DIRECTORY'), help='Split a single database into a new directory of shards')
+    parser.add_argument('--list', type=str, default='', help='Print the shard catalog of this directory')
+    parser.add_argument('--layout', type=str, default='normalized', choices=LAYOUTS, help='Layout of new shards')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    if args.split:
+        old, new = args.split
+        if not os.path.isfile(old):
+            logging.error('{0} does not exist'.format(old))
+            return 1
+        if os.path.exists(new):
+            logging.error('{0} already exists'.format(new))
+            return 1
+        api = ShardedLogMonitorAPI(new,layout=args.layout)
+        api.migrate(old)
+        return
+
+    if args.list:
+        api = ShardedLogMonitorAPI(args.list,readonly=True)
+        for shard in api.listShards():
+            print '{shard:20} {path:24} {first_dataset} .. {last_dataset}'.format(**shard)
+        return
+
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    # simple setup, two eras
+    path = 'test.shards'
+    if os.path.isdir(path):
+        for f in os.listdir(path): os.remove(os.path.join(path,f))
+        os.rmdir(path)
+    api = ShardedLogMonitorAPI(path,layout=args.layout)
+    for file_name,dataset,count in [('dummy','/a/Run2016B-v1/c',1),('dummy2','/a/Run2016B-v1/c',2),('dummy3','/b/Run2017A-v1/c',4)]:
+        with api.transaction():
+            api.insertModules([
+                {'file_name':file_name,'module':'mod1','severity':'INFO','count':count,'log_key':'ModErrorType'},
+                {'file_name':file_name,'module':'mod2','severity':'WARNING','count':2*count,'log_key':'OtherErrorType'},
+            ])
+            api.insertProcessedFile(file_name=file_name,dataset=dataset)
+    api.insertDatasetMark('/b/Run2017A-v1/c',1)
+
+    # failed transaction leaves nothing behind in any shard
+    try:
+        with api.transaction():
+            api.insertModule(file_name='dummy4',module='mod1',severity='INFO',count=1,log_key='ModErrorType')
+            api.insertProcessedFile(file_name='dummy4',dataset='/b/Run2018A-v1/c')
+            raise RuntimeError('simulated crash')
+    except RuntimeError as e:
+        logging.info(e)
+
+    print api.listShards()
+    print api.listProcessedFiles(dataset='/*/Run2016*/*')
+    print api.listModules(file_name='dummy3')
+    print api.summarizeDatasets(dataset='/*/Run2017A-*/*')
+    print api.summarizeDatasets(merge_datasets=True,order_by='count',limit=1)
+    print api.summarize(file_names=['dummy','dummy3'],order_by='count')
+    print api.compareDatasets('/a/Run2016B-v1/c','/b/Run2017A-v1/c')
+    print api.getProcessedFileNames(dataset=['/a/Run2016B-v1/c','/d/e/f'])
+    print api.listDatasetMarks(dataset='/b/*')
+    print api.getGeneration()
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
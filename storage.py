@@ -0,0 +1,89 @@
+import os
+import sys
+import logging
+import subprocess
+from abc import ABCMeta, abstractmethod
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+# xrootd error number of a missing file or directory (kXR_NotFound)
+XRD_NOT_FOUND = 3011
+
+class StorageLister(object):
+    '''
+    Directory listing of a storage element, listdir returns the entry names or an empty list if the directory does not exist.
+    Any other failure raises IOError, so an unreachable storage is not mistaken for an empty directory.
+    '''
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def listdir(self,path):
+        pass
+
+class LocalLister(StorageLister):
+    '''Listing of a local or FUSE mounted file system, LFNs are looked up below root'''
+
+    def __init__(self,root='/eos/cms'):
+        self.root = root
+
+    def listdir(self,path):
+        fullpath = os.path.join(self.root,path.lstrip('/'))
+        if not os.path.isdir(fullpath): return []
+        if hasattr(os,'scandir'):
+            return [entry.name for entry in os.scandir(fullpath)]
+        return os.listdir(fullpath)
+
+class XRootDLister(StorageLister):
+    '''Listing through the xrootd client bindings'''
+
+    def __init__(self,server='eoscms.cern.ch'):
+        # xrootd python bindings, only imported when this backend is used
+        try:
+            from XRootD import client as xrdclient
+        except ImportError:
+            logging.error('The XRootD python bindings are not available.')
+            raise
+        self.fs = xrdclient.FileSystem('root://{0}'.format(server))
+
+    def listdir(self,path):
+        status, listing = self.fs.dirlist(path)
+        if not status.ok:
+            if status.errno==XRD_NOT_FOUND: return []
+            raise IOError('Listing {0} failed: {1}'.format(path,status.message))
+        return [entry.name for entry in listing]
+
+class EOSLister(StorageLister):
+    '''Listing through the eos command line client'''
+
+    def __init__(self,eos='/afs/cern.ch/project/eos/installation/0.3.84-aquamarine/bin/eos.select'):
+        self.eos = eos
+
+    def listdir(self,path):
+        proc = subprocess.Popen([self.eos,'ls',path],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode:
+            if 'No such file or directory' in err: return []
+            raise IOError('{0} ls {1} failed: {2}'.format(self.eos,path,err.strip()))
+        return [x.strip() for x in out.split()]
+
+class CachedLister(StorageLister):
+    '''Remember the listings of a lister for the duration of a run, failed listings raise and are not remembered'''
+
+    def __init__(self,lister):
+        self.lister = lister
+        self.listings = {}
+
+    def listdir(self,path):
+        path = path.rstrip('/')
+        if path not in self.listings:
+            self.listings[path] = self.lister.listdir(path)
+        return self.listings[path]
+
+def getStorageLister(backend='eos',**kwargs):
+    '''Create a cached lister for the backend, one of eos, local, xrootd'''
+    backends = {
+        'eos' : EOSLister,
+        'local' : LocalLister,
+        'xrootd' : XRootDLister,
+    }
+    return CachedLister(backends[backend](**kwargs))